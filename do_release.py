@@ -22,7 +22,7 @@ argsets = [
     ('--size=sleeved', 'sleeved_'),
     ('--size=sleeved --orientation=vertical', 'vertical_sleeved_')
 ]
-additional = ['--expansion_dividers']
+additional = ['--expansion_dividers', '--optimize-size', '--deterministic']
 
 fnames = [doit(args[0] + ' ' + ' '.join(additional), args[1])
           for args in argsets]
@@ -1,20 +1,41 @@
 import os
+import re
 import codecs
 import json
 import sys
+import copy
+import time
+import shlex
+import math
+import shutil
+import hashlib
+import traceback
 import argparse
+import cStringIO
+import threading
+from multiprocessing import Pool, TimeoutError, cpu_count
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image
 
 import reportlab.lib.pagesizes as pagesizes
 from reportlab.lib.units import cm
 
-from cards import Card
-from draw import DividerDrawer
+from cards import Card, CardIndex, cardTypes, compiledTables
+import carddb
+from draw import DividerDrawer, RenderCancelled, packWrappers
+from preview import PreviewCanvas, SVGPreviewCanvas
 
 LOCATION_CHOICES = ["tab", "body-top", "hide"]
 NAME_ALIGN_CHOICES = ["left", "right", "centre", "edge"]
 TAB_SIDE_CHOICES = ["left", "right", "left-alternate", "right-alternate",
                     "centre", "full"]
 TEXT_CHOICES = ["card", "rules", "blank"]
+# options that decide which cards are printed and in what order
+FILTER_OPTIONS = ["language", "order", "expansions", "base_cards_with_expansion",
+                  "special_card_groups", "exclude_events", "exclude_landmarks",
+                  "exclude_prizes", "cardlist", "expansion_dividers", "write_json", "sqlite_db"]
+COMPILED_CARD_DB = "cards_compiled.json"
 
 
 def add_opt(options, option, value):
@@ -38,10 +59,11 @@ def parse_opts(arglist):
         default=0,
         help="Points to offset the back page upward; needed for some printers")
     parser.add_argument("--orientation",
-                        choices=["horizontal", "vertical"],
+                        choices=["horizontal", "vertical", "auto"],
                         dest="orientation",
                         default="horizontal",
-                        help="horizontal or vertical, default:horizontal")
+                        help="horizontal or vertical, or auto to use whichever"
+                        " needs the fewest pages, default:horizontal")
     parser.add_argument("--sleeved",
                         action="store_true",
                         dest="sleeved",
@@ -176,7 +198,9 @@ def parse_opts(arglist):
         help="stop generating after this many pages, -1 for all")
     parser.add_argument("--language",
                         default='en_us',
-                        help="language of card texts")
+                        help="language of card texts; 'all' or a comma separated list"
+                        " (e.g. 'en_us,de') writes one file per language, named after"
+                        " the outfile with the language appended")
     parser.add_argument("--include_blanks",
                         action="store_true",
                         help="include a few dividers with extra text")
@@ -257,6 +281,131 @@ def parse_opts(arglist):
                         action="store_true",
                         dest="notch",
                         help="same as --notch_length thickness 1.5")
+    parser.add_argument(
+        "--optimize-size",
+        action="store_true",
+        dest="optimize_size",
+        help="make the output file as small as possible: compress every stream without"
+        " ASCII85 encoding, embed identical images only once and print the size taken"
+        " up by each kind of resource (fonts are always subset to the glyphs used)."
+        " This shrinks the standard release files by roughly 20%%.")
+    parser.add_argument(
+        "--image_dpi",
+        type=int,
+        default=300,
+        help="resolution the dividers will be printed at.  If --build_images has made copies"
+        " of the images for it, those are embedded instead of the full size images, giving"
+        " smaller files that are quicker to write (default: 300)")
+    parser.add_argument(
+        "--full_resolution_images",
+        action="store_true",
+        help="always embed the images at their full resolution, ignoring any copies made by"
+        " --build_images")
+    parser.add_argument(
+        "--build_images",
+        action="store_true",
+        help="write copies of the images scaled down to what printing at --image_dpi needs"
+        " into images_<dpi>dpi next to the images directory, to be used from then on.  Run"
+        " it again after changing the images")
+    parser.add_argument(
+        "--deterministic",
+        action="store_true",
+        help="write the same bytes every time for the same options and data, leaving out"
+        " the creation time and random document ID, and print a hash of the output that"
+        " can be used to tell whether it changed")
+    parser.add_argument(
+        "--variant",
+        action="append",
+        default=[],
+        help="options for one output of a batch, e.g. '--orientation vertical --papersize A4',"
+        " added to the options given on the command line; may be given multiple times."
+        " Cards are only read and filtered once for all variants that select the same cards,"
+        " and the time taken by each variant is reported at the end")
+    parser.add_argument(
+        "--batch",
+        dest="batch",
+        help="Path to a file with the options for one batch variant per line (see --variant)")
+    parser.add_argument(
+        "--kingdoms",
+        help="render one output per card list instead of a single one.  Either a JSON lines"
+        " file with an object per card list, holding its card names under 'cards' or the"
+        " path of a --cardlist file under 'cardlist' and optionally a 'name', or a directory"
+        " of --cardlist files.  The card database is only read and sorted once and the"
+        " lists are rendered by --workers processes into files named after the outfile and"
+        " the list's name")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes used for --kingdoms, --tiles and --split-by, and for"
+        " fitting the texts of the dividers before drawing them (default: one per CPU, and"
+        " the texts are only fitted by other processes when there are enough dividers for"
+        " it to pay off)")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        dest="dry_run",
+        help="work out the layout and the font sizes of the tab names and texts without"
+        " drawing anything, and report the number of pages, the dividers on each page,"
+        " the font sizes of each card and the cards whose names or texts come out too small"
+        " to read.  Nothing is written")
+    parser.add_argument(
+        "--compile_db",
+        action="store_true",
+        help="check the card database of the selected language(s) against the known card types"
+        " and the images, report any problems and write a render-ready " + COMPILED_CARD_DB +
+        " next to cards.json.  It is used instead of cards.json until either that or"
+        " mapping.json change.  With --sqlite_db, the checked cards are stored there too."
+        "  Exits with status 1 if there were any problems")
+    parser.add_argument(
+        "--sqlite_db",
+        help="SQLite card database holding any number of languages to read the cards from,"
+        " instead of the card_db directory.  It is filled by --compile_db or"
+        " tools/convert_csv.py and can be searched by set, type, cost and text")
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running after generating the output and generate it again whenever the"
+        " card database or the images change; only the languages affected by a change are"
+        " generated again")
+    parser.add_argument(
+        "--preview",
+        type=int,
+        help="write a PNG of the front of the given page (counting from 1) to the outfile"
+        " name with a .png extension instead of generating the PDF; 0 lays out all pages"
+        " side by side, rendering them in parallel")
+    parser.add_argument(
+        "--preview_card",
+        help="write a PNG of just the divider for the named card (see --preview)")
+    parser.add_argument(
+        "--preview_dpi",
+        type=int,
+        default=72,
+        help="resolution of the preview image and of PNG --tiles")
+    parser.add_argument(
+        "--preview_cache",
+        help="directory to keep rendered previews in; a preview is only rendered again"
+        " when the options or the card database have changed")
+    parser.add_argument(
+        "--tiles",
+        help="directory to write an image of each selected divider to, instead of generating"
+        " the PDF, with an index.json listing them in order.  Tiles are named after their"
+        " card and layout, so when run again only the tiles that changed are rendered (by"
+        " --workers processes) and the ones no longer listed are removed")
+    parser.add_argument(
+        "--tile_format",
+        choices=["png", "svg"],
+        default="png",
+        help="image format of --tiles")
+    parser.add_argument(
+        "--split-by",
+        dest="split_by",
+        type=parse_split_by,
+        help="write a separate output per group of dividers instead of a single one: either"
+        " 'expansion' or 'pages:N' for every N pages of dividers (not counting their backs)."
+        "  The cards are only read and sorted once,"
+        " the groups are rendered by --workers processes into files named after the outfile"
+        " and the group, and a _manifest.json next to them lists the files.  Page groups carry"
+        " on the alternating tab sides from one file to the next")
 
     options = parser.parse_args(arglist)
     if not options.cost:
@@ -278,20 +427,24 @@ def parse_opts(arglist):
     return options
 
 
+def parse_split_by(spec):
+    if spec == 'expansion':
+        return spec, None
+    kind, _, size = spec.partition(':')
+    if kind != 'pages' or not size.isdigit() or not int(size):
+        raise argparse.ArgumentTypeError("expected 'expansion' or 'pages:N', got '{}'".format(spec))
+    return kind, int(size)
+
+
 def parseDimensions(dimensionsStr):
     x, y = dimensionsStr.upper().split('X', 1)
     return (float(x) * cm, float(y) * cm)
 
 
-def generate_sample(options):
-    import cStringIO
-    from wand.image import Image
-    buf = cStringIO.StringIO()
-    options.num_pages = 1
-    generate(options, '.', buf)
-    with Image(blob=buf.getvalue()) as sample:
-        sample.format = 'png'
-        sample.save(filename='sample.png')
+def generate_sample(options, data_path='.'):
+    options.preview = 1
+    options.outfile = 'sample.pdf'
+    generate_preview(options, data_path)
 
 
 def parse_papersize(spec):
@@ -333,17 +486,99 @@ def parse_cardsize(spec, sleeved):
     return dominionCardWidth, dominionCardHeight
 
 
-def read_write_card_data(options):
-    data_dir = os.path.join(options.data_path, "card_db", options.language)
-    card_db_filepath = os.path.join(data_dir, "cards.json")
-    with codecs.open(card_db_filepath, "r", "utf-8") as cardfile:
-        cards = json.load(cardfile, object_hook=Card.decode_json)
+def card_db_digest(data_dir):
+    # identifies the source files a compiled database was made from, and
+    # the tables of the code compiling them
+    digest = hashlib.md5(compiledTables())
+    for fname in ["cards.json", "mapping.json"]:
+        with open(os.path.join(data_dir, fname), 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def read_compiled_card_data(data_dir):
+    compiled_filepath = os.path.join(data_dir, COMPILED_CARD_DB)
+    if not os.path.exists(compiled_filepath):
+        return None
+    with codecs.open(compiled_filepath, "r", "utf-8") as compiledfile:
+        compiled = json.load(compiledfile)
+    if compiled['source'] != card_db_digest(data_dir):
+        print 'Ignoring out of date ' + compiled_filepath
+        return None
+    # decoded here rather than with an object_hook, as the cards hold
+    # dictionaries of their own
+    return [Card.decode_json(obj) for obj in compiled['cards']]
+
+
+def read_card_data(options):
+    # returns the cards and the language mapping of options.language
+    if options.sqlite_db:
+        conn = carddb.connect(options.sqlite_db, create=False)
+        try:
+            return carddb.read_language(conn, options.language)
+        finally:
+            conn.close()
 
-    assert cards, "Could not load any cards from database"
+    data_dir = os.path.join(options.data_path, "card_db", options.language)
+    cards = read_compiled_card_data(data_dir)
+    if cards is None:
+        card_db_filepath = os.path.join(data_dir, "cards.json")
+        with codecs.open(card_db_filepath, "r", "utf-8") as cardfile:
+            cards = json.load(cardfile, object_hook=Card.decode_json)
 
     language_mapping_filepath = os.path.join(data_dir, "mapping.json")
     with codecs.open(language_mapping_filepath, 'r', 'utf-8') as mapping_file:
-        Card.language_mapping = json.load(mapping_file)
+        language_mapping = json.load(mapping_file)
+    return cards, language_mapping
+
+
+# the card index of each data path, built from the card databases of all
+# languages the first time it is needed
+card_indexes = {}
+
+
+def card_index(data_path):
+    if data_path not in card_indexes:
+        index = CardIndex()
+        card_db = os.path.join(data_path, "card_db")
+        for language in sorted(os.listdir(card_db)):
+            card_db_filepath = os.path.join(card_db, language, "cards.json")
+            if not os.path.exists(card_db_filepath):
+                continue
+            with codecs.open(card_db_filepath, "r", "utf-8") as cardfile:
+                for obj in json.load(cardfile):
+                    index.add(language, obj['name'].strip(), obj.get('card_id'))
+        card_indexes[data_path] = index
+    return card_indexes[data_path]
+
+
+def select_cards(cards, names, options):
+    # the cards named, in any language, and the names no card was found for
+    index = card_index(options.data_path)
+    names = set(names)
+    ids = {}
+    for name in names:
+        card_id = index.cardId(name, options.language)
+        if card_id:
+            ids.setdefault(card_id, set()).add(name)
+    selected = []
+    found = set()
+    for card in cards:
+        if card.name in names:
+            found.add(card.name)
+        elif card.card_id not in ids:
+            continue
+        found.update(ids.get(card.card_id, ()))
+        selected.append(card)
+    return selected, sorted(names - found)
+
+
+def read_write_card_data(options):
+    cards, language_mapping = read_card_data(options)
+    assert cards, "Could not load any cards from database"
+
+    for card in cards:
+        card.language_mapping = language_mapping
 
     if options.write_json:
         fpath = "cards.json"
@@ -357,6 +592,132 @@ def read_write_card_data(options):
     return cards
 
 
+def compile_language(data_dir, images):
+    # returns the compiled cards of one language and the problems found
+    with codecs.open(os.path.join(data_dir, "cards.json"), "r", "utf-8") as cardfile:
+        card_data = json.load(cardfile)
+    with codecs.open(os.path.join(data_dir, "mapping.json"), 'r', 'utf-8') as mapping_file:
+        language_mapping = json.load(mapping_file)
+
+    problems = []
+    missing = set()
+    no_set_image = {}
+    cards = []
+    for obj in card_data:
+        if tuple(obj.get('types', ())) not in cardTypes:
+            problems.append(u'unknown types {} for card "{}"'.format(
+                '-'.join(obj.get('types', ())), obj.get('name')))
+            continue
+        card = Card.decode_json(obj)
+        card.language_mapping = language_mapping
+        card.compile()
+        cards.append(card)
+        if not card.card_id:
+            # cards are found in other languages by their id
+            problems.append(u'no card_id for card "{}"'.format(card.name))
+
+        if card.set_image is None and card.cardset != 'base':
+            no_set_image.setdefault(card.cardset, []).append(card.name)
+        wanted = [card.set_image, card.tab_image]
+        for template in card.markup.itervalues():
+            wanted.extend(re.findall(r"src='%\(([^)]+)\)s'", template))
+        for img in wanted:
+            if img and img not in images and img not in missing:
+                missing.add(img)
+                problems.append(u'missing image {} (first used by "{}")'.format(img, card.name))
+
+    for cardset in sorted(no_set_image):
+        names = no_set_image[cardset]
+        problems.append(u'no set image for set "{}" ({} cards, e.g. "{}")'.format(
+            cardset, len(names), names[0]))
+    if not cards:
+        problems.append(u'no cards')
+    return cards, problems
+
+
+def compile_card_db(options, data_path):
+    add_opt(options, 'data_path', data_path)
+    images = set(os.listdir(os.path.join(data_path, "images")))
+    problem_count = 0
+    for language in get_languages(options):
+        data_dir = os.path.join(data_path, "card_db", language)
+        cards, problems = compile_language(data_dir, images)
+        for problem in problems:
+            print u'{}: {}'.format(language, problem).encode('utf-8')
+        problem_count += len(problems)
+
+        compiled_filepath = os.path.join(data_dir, COMPILED_CARD_DB)
+        with codecs.open(compiled_filepath, 'w', encoding='utf-8') as ofile:
+            json.dump({'source': card_db_digest(data_dir), 'cards': cards},
+                      ofile,
+                      cls=Card.CompiledCardJSONEncoder,
+                      ensure_ascii=False,
+                      sort_keys=True)
+        print 'Wrote {} cards to {}'.format(len(cards), compiled_filepath)
+
+        if options.sqlite_db and cards:
+            conn = carddb.connect(options.sqlite_db)
+            try:
+                carddb.store_language(conn, language, cards, cards[0].language_mapping)
+            finally:
+                conn.close()
+            print 'Stored {} cards in {}'.format(len(cards), options.sqlite_db)
+    # the exit status, so scripts can tell
+    return 1 if problem_count else 0
+
+
+# the largest box, in points, the small images are drawn into; the others,
+# such as the tab banners drawn as wide as the tab, are kept as they are
+IMAGE_BOXES = [
+    (re.compile(r'_set\.png$'), (14, 12)),
+    (re.compile(r'^potion\.png$'), (11, 11)),
+    (re.compile(r'^(card|coin_small.*|debt.*|potion_small|victory_emblem)\.png$'), (18, 18)),
+]
+
+
+def scale_image(im, box, dpi):
+    # the image scaled down to fill the box at the resolution, or None if
+    # it is already no larger than that
+    scale = max(box[0] * dpi / 72.0 / im.size[0], box[1] * dpi / 72.0 / im.size[1])
+    if scale >= 1:
+        return None
+    size = (int(math.ceil(im.size[0] * scale)), int(math.ceil(im.size[1] * scale)))
+    if 'A' not in im.mode and 'transparency' not in im.info:
+        return im.convert('RGB').resize(size, Image.LANCZOS)
+    # resampled premultiplied by the mask, so the colour of transparent
+    # pixels does not bleed into the edges; transparent pixels come out
+    # white, which the images drawn with a white colour key mask rely on
+    scaled = im.convert('RGBA').convert('RGBa').resize(size, Image.LANCZOS).convert('RGBA')
+    white = Image.new('RGBA', size, (255, 255, 255, 0))
+    return Image.composite(scaled, white, scaled.split()[3].point(lambda a: 255 if a else 0))
+
+
+def build_images(options, data_path):
+    image_dir = os.path.join(data_path, "images")
+    scaled_dir = '{}_{}dpi'.format(image_dir, options.image_dpi)
+    tmp_dir = scaled_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    before = after = 0
+    for fname in sorted(os.listdir(image_dir)):
+        path = os.path.join(image_dir, fname)
+        box = next((box for pattern, box in IMAGE_BOXES if pattern.search(fname)), None)
+        scaled = scale_image(Image.open(path), box, options.image_dpi) if box else None
+        if scaled is None:
+            shutil.copy2(path, os.path.join(tmp_dir, fname))
+        else:
+            scaled.save(os.path.join(tmp_dir, fname), optimize=True)
+        before += os.path.getsize(path)
+        after += os.path.getsize(os.path.join(tmp_dir, fname))
+    # swapped in whole, so a job never sees half the images
+    if os.path.exists(scaled_dir):
+        shutil.rmtree(scaled_dir)
+    os.rename(tmp_dir, scaled_dir)
+    print 'Wrote {} ({}KB, {}KB at full resolution)'.format(scaled_dir, after // 1024, before // 1024)
+    return 0
+
+
 class CardSorter(object):
     def __init__(self, order, baseCards):
         self.order = order
@@ -397,8 +758,21 @@ class CardSorter(object):
         return self.sort_key(card)
 
 
+def get_languages(options):
+    if options.language == 'all':
+        db_dir = os.path.join(options.data_path, "card_db")
+        return sorted(
+            lang for lang in os.listdir(db_dir)
+            if os.path.exists(os.path.join(db_dir, lang, "cards.json")))
+    return [lang.strip() for lang in options.language.split(',')
+            if lang.strip()]
+
+
 def filter_sort_cards(cards, options):
 
+    # all cards read from one database share their language's mapping
+    language_mapping = cards[0].language_mapping
+
     cardSorter = CardSorter(
         options.order,
         [card.name for card in cards if card.cardset.lower() == 'base'])
@@ -416,40 +790,59 @@ def filter_sort_cards(cards, options):
             card_groups = json.load(cardgroup_file)
             # pull out any cards which are a subcard, and rename the master card
             new_cards = []  # holds the cards that are to be kept
-            all_subcards = []  # holds names of cards that will be removed
+            all_subcards = set()  # holds refs of cards that will be removed
             subcard_parent = {
             }  # holds reverse map of subcard name to group name
             subcard_count = {
             }  # holds total card count of the subcards for a group
 
+            # the group files name their cards in their own language or in
+            # English, so cards are matched up by id where they have one
+            index = card_index(options.data_path)
+
+            def ref(name):
+                return index.cardId(name, options.language) or name
+
+            # groups found only through another language are left alone if
+            # their own card is not in the database
+            present = set(card.card_id or card.name for card in cards)
+            names = set(card.name for card in cards)
+
             # Initialize each of the new card groups
             for group in card_groups:
-                subcard_count[group] = 0
+                if ref(group) not in present and names.isdisjoint(card_groups[group]["subcards"]):
+                    continue
+                subcard_count[ref(group)] = 0
                 for subs in card_groups[group]["subcards"]:
-                    all_subcards.append(
-                        subs)  # add card names to the list for removal
+                    all_subcards.add(
+                        ref(subs))  # add card refs to the list for removal
                     subcard_parent[
-                        subs] = group  # create the reverse mapping of subgroup to group
+                        ref(subs)] = ref(group)  # create the reverse mapping of subgroup to group
 
                     # go through the cards and add up the number of subgroup cards
             for card in cards:
-                if card.name in all_subcards:
+                if (card.card_id or card.name) in all_subcards:
                     subcard_count[subcard_parent[
-                        card.name]] += card.getCardCount()
+                        card.card_id or card.name]] += card.getCardCount()
+
+            # the groups are only renamed in the language they are written in
+            groups = {ref(group): group for group in card_groups}
 
-                    # fix up the group card holders count & name, and weed out the subgroup cards
+            # fix up the group card holders count & name, and weed out the subgroup cards
             for card in cards:
-                if card.name in card_groups.keys():
-                    card.count += subcard_count[card.name]
-                    card.name = card_groups[card.name]["new_name"]
-                elif card.name in all_subcards:
+                group = groups.get(card.card_id or card.name)
+                if group is not None:
+                    new_name = card_groups[group]["new_name"] if card.name == group else card.name
+                    card = card.overlay(count=card.count + subcard_count[card.card_id or card.name],
+                                        name=new_name)
+                elif (card.card_id or card.name) in all_subcards:
                     continue
                 new_cards.append(card)
             cards = new_cards
 
     if options.expansions:
         options.expansions = [o.lower() for o in options.expansions]
-        reverseMapping = {v: k for k, v in Card.language_mapping.iteritems()}
+        reverseMapping = {v: k for k, v in language_mapping.iteritems()}
         options.expansions = [
             reverseMapping.get(e, e) for e in options.expansions
         ]
@@ -480,7 +873,7 @@ def filter_sort_cards(cards, options):
             else:
                 filteredCards.append(c)
         if holder and count > 0:
-            holder.setCardCount(count)
+            filteredCards[filteredCards.index(holder)] = holder.overlay(count=count)
         cards = filteredCards
 
     if options.exclude_landmarks:
@@ -496,7 +889,7 @@ def filter_sort_cards(cards, options):
             else:
                 filteredCards.append(c)
         if holder and count > 0:
-            holder.setCardCount(count)
+            filteredCards[filteredCards.index(holder)] = holder.overlay(count=count)
         cards = filteredCards
 
     if options.exclude_prizes:
@@ -512,16 +905,20 @@ def filter_sort_cards(cards, options):
             else:
                 filteredCards.append(c)
         if holder and count > 0:
-            holder.setCardCount(count)
+            filteredCards[filteredCards.index(holder)] = holder.overlay(count=count)
         cards = filteredCards
 
     if options.cardlist:
         cardlist = set()
-        with open(options.cardlist) as cardfile:
+        with codecs.open(options.cardlist, 'r', 'utf-8') as cardfile:
             for line in cardfile:
                 cardlist.add(line.strip())
         if cardlist:
-            cards = [card for card in cards if card.name in cardlist]
+            # the list may name the cards in any language
+            cards, unknown = select_cards(cards, cardlist, options)
+            if unknown:
+                print u'warning, no card found for {} in {}'.format(
+                    u', '.join(u'"{}"'.format(name) for name in unknown), options.cardlist).encode('utf-8')
 
     if options.expansion_dividers:
         cardnamesByExpansion = {}
@@ -536,24 +933,70 @@ def filter_sort_cards(cards, options):
                      None,
                      ' | '.join(sorted(names)),
                      count=len(names))
+            c.language_mapping = language_mapping
             cards.append(c)
 
     cards.sort(key=cardSorter)
 
+    bind_assets(cards, options)
     return cards
 
 
+def bind_assets(cards, options):
+    # resolve every card's images once the list is final, reporting those
+    # that are missing once per set
+    missing = {}
+    for card in cards:
+        if not card.bound:
+            card.bindAssets()
+        if card.cardset == 'base':
+            continue
+        if options.use_text_set_icon:
+            setIcon = card.set_text, 'text'
+        else:
+            setIcon = card.set_image, 'image'
+        if setIcon[0] is None:
+            missing.setdefault((setIcon[1], card.cardset), []).append(card.name)
+    for (kind, cardset), names in sorted(missing.iteritems()):
+        print u'warning, no set {} for set "{}" ({} cards, e.g. "{}")'.format(
+            kind, cardset, len(names), names[0]).encode('utf-8')
+
+
+def pdf_resource_sizes(fname):
+    # Break the written PDF up into its objects and tally the bytes used
+    # by each kind of resource
+    sizes = {'images': 0, 'fonts': 0, 'page content': 0, 'other': 0}
+    with open(fname, 'rb') as pdffile:
+        data = pdffile.read()
+    for obj in re.finditer(r'\d+ \d+ obj(.*?)endobj', data, re.DOTALL):
+        body = obj.group(1)
+        if '/Subtype /Image' in body:
+            kind = 'images'
+        elif ('/Length1' in body or '/Type /Font' in body or
+              '/Type /FontDescriptor' in body):
+            kind = 'fonts'
+        elif 'stream' in body:
+            kind = 'page content'
+        else:
+            kind = 'other'
+        sizes[kind] += len(obj.group(0))
+    return sizes
+
+
+def content_hash(fname):
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def calculate_layout(options, cards=[]):
 
     dominionCardWidth, dominionCardHeight = parse_cardsize(options.size,
                                                            options.sleeved)
     paperwidth, paperheight = parse_papersize(options.papersize)
 
-    if options.orientation == "vertical":
-        dividerWidth, dividerBaseHeight = dominionCardHeight, dominionCardWidth
-    else:
-        dividerWidth, dividerBaseHeight = dominionCardWidth, dominionCardHeight
-
     if options.tab_name_align == "center":
         options.tab_name_align = "centre"
 
@@ -562,37 +1005,17 @@ def calculate_layout(options, cards=[]):
         print >> sys.stderr, "** Warning: Aligning card name as 'left' for 'full' tabs **"
         options.tab_name_align = "left"
 
-    fixedMargins = False
-    if options.tabs_only:
-        # fixed for Avery 8867 for now
-        minmarginwidth = 0.86 * cm  # was 0.76
-        minmarginheight = 1.37 * cm  # was 1.27
-        labelHeight = 1.07 * cm  # was 1.27
-        labelWidth = 4.24 * cm  # was 4.44
-        horizontalBorderSpace = 0.96 * cm  # was 0.76
-        verticalBorderSpace = 0.20 * cm  # was 0.01
-        dividerBaseHeight = 0
-        dividerWidth = labelWidth
-        fixedMargins = True
+    if options.orientation == "auto" and not options.tabs_only:
+        orientations = ["horizontal", "vertical"]
+    elif options.orientation == "auto":
+        # labels are the same whichever way the cards are held
+        orientations = ["horizontal"]
     else:
-        minmarginwidth, minmarginheight = parseDimensions(options.minmargin)
-        if options.tab_side == "full":
-            labelWidth = dividerWidth
-        else:
-            labelWidth = options.tabwidth * cm
-        labelHeight = .9 * cm
-        horizontalBorderSpace = options.horizontal_gap * cm
-        verticalBorderSpace = options.vertical_gap * cm
-
-    dividerHeight = dividerBaseHeight + labelHeight
+        orientations = [options.orientation]
 
-    dividerWidthReserved = dividerWidth + horizontalBorderSpace
-    dividerHeightReserved = dividerHeight + verticalBorderSpace
     if options.wrapper:
         max_card_stack_height = max(c.getStackHeight(options.thickness)
                                     for c in cards)
-        dividerHeightReserved = (dividerHeightReserved * 2) + (
-            max_card_stack_height * 2)
         print "Max Card Stack Height: {:.2f}cm ".format(max_card_stack_height)
 
     # Notch measurements
@@ -600,71 +1023,309 @@ def calculate_layout(options, cards=[]):
     notch_width1 = options.notch_length * cm  # thumb notch width: top away from tab
     notch_width2 = 0.00 * cm  # thumb notch width: bottom on side of tab
 
-    add_opt(options, 'dividerWidth', dividerWidth)
-    add_opt(options, 'dividerHeight', dividerHeight)
-    add_opt(options, 'dividerBaseHeight', dividerBaseHeight)
-    add_opt(options, 'dividerWidthReserved', dividerWidthReserved)
-    add_opt(options, 'dividerHeightReserved', dividerHeightReserved)
-    add_opt(options, 'labelWidth', labelWidth)
-    add_opt(options, 'labelHeight', labelHeight)
+    layouts = []
+    for orientation in orientations:
+        if orientation == "vertical":
+            dividerWidth, dividerBaseHeight = dominionCardHeight, dominionCardWidth
+        else:
+            dividerWidth, dividerBaseHeight = dominionCardWidth, dominionCardHeight
+
+        fixedMargins = False
+        if options.tabs_only:
+            # fixed for Avery 8867 for now
+            minmarginwidth = 0.86 * cm  # was 0.76
+            minmarginheight = 1.37 * cm  # was 1.27
+            labelHeight = 1.07 * cm  # was 1.27
+            labelWidth = 4.24 * cm  # was 4.44
+            horizontalBorderSpace = 0.96 * cm  # was 0.76
+            verticalBorderSpace = 0.20 * cm  # was 0.01
+            dividerBaseHeight = 0
+            dividerWidth = labelWidth
+            fixedMargins = True
+        else:
+            minmarginwidth, minmarginheight = parseDimensions(options.minmargin)
+            if options.tab_side == "full":
+                labelWidth = dividerWidth
+            else:
+                labelWidth = options.tabwidth * cm
+            labelHeight = .9 * cm
+            horizontalBorderSpace = options.horizontal_gap * cm
+            verticalBorderSpace = options.vertical_gap * cm
+
+        dividerHeight = dividerBaseHeight + labelHeight
+
+        dividerWidthReserved = dividerWidth + horizontalBorderSpace
+        dividerHeightReserved = dividerHeight + verticalBorderSpace
+        if options.wrapper:
+            dividerHeightReserved = (dividerHeightReserved * 2) + (
+                max_card_stack_height * 2)
+
+        layout = {'orientation': orientation,
+                  'dividerWidth': dividerWidth,
+                  'dividerHeight': dividerHeight,
+                  'dividerBaseHeight': dividerBaseHeight,
+                  'dividerWidthReserved': dividerWidthReserved,
+                  'dividerHeightReserved': dividerHeightReserved,
+                  'labelWidth': labelWidth,
+                  'labelHeight': labelHeight}
+        if options.wrapper:
+            # kept for packing the wrappers of any part of the cards into
+            # the rows of this layout
+            layout['maxStackHeight'] = max_card_stack_height
+
+        # as we don't draw anything in the final border, it shouldn't count towards how many tabs we can fit
+        # so it gets added back in to the page size here
+        numDividersVerticalP = int(
+            (paperheight - 2 * minmarginheight + verticalBorderSpace) /
+            dividerHeightReserved)
+        numDividersHorizontalP = int(
+            (paperwidth - 2 * minmarginwidth + horizontalBorderSpace) /
+            dividerWidthReserved)
+        numDividersVerticalL = int(
+            (paperwidth - 2 * minmarginwidth + verticalBorderSpace) /
+            dividerHeightReserved)
+        numDividersHorizontalL = int(
+            (paperheight - 2 * minmarginheight + horizontalBorderSpace) /
+            dividerWidthReserved)
+
+        if ((numDividersVerticalL * numDividersHorizontalL > numDividersVerticalP *
+             numDividersHorizontalP) and not fixedMargins):
+            layout.update(numDividersVertical=numDividersVerticalL,
+                          numDividersHorizontal=numDividersHorizontalL,
+                          paperheight=paperwidth,
+                          paperwidth=paperheight,
+                          minHorizontalMargin=minmarginheight,
+                          minVerticalMargin=minmarginwidth,
+                          minTopBottomMargin=minmarginwidth)
+        else:
+            layout.update(numDividersVertical=numDividersVerticalP,
+                          numDividersHorizontal=numDividersHorizontalP,
+                          paperheight=paperheight,
+                          paperwidth=paperwidth,
+                          minHorizontalMargin=minmarginheight,
+                          minVerticalMargin=minmarginwidth,
+                          minTopBottomMargin=minmarginheight)
+
+        if not fixedMargins:
+            # dynamically max margins
+            layout['horizontalMargin'] = (
+                layout['paperwidth'] - layout['numDividersHorizontal'] *
+                dividerWidthReserved + horizontalBorderSpace) / 2
+            layout['verticalMargin'] = (
+                layout['paperheight'] - layout['numDividersVertical'] *
+                dividerHeightReserved + verticalBorderSpace) / 2
+        else:
+            layout['horizontalMargin'] = minmarginwidth
+            layout['verticalMargin'] = minmarginheight
+
+        layouts.append(layout)
+
+    # fewest pages wins, and most dividers on a page when there are no cards yet
+    pages = [count_layout_pages(cards, options, layout) for layout in layouts]
+    best = min(range(len(layouts)),
+               key=lambda i: (pages[i], -layouts[i]['numDividersVertical'] *
+                              layouts[i]['numDividersHorizontal']))
+    layout = layouts[best]
+    if len(layouts) > 1:
+        print "Using {} orientation: {} pages ({})".format(
+            layout['orientation'], pages[best],
+            ', '.join('{} {}'.format(other['orientation'], otherPages)
+                      for other, otherPages in zip(layouts, pages) if other is not layout))
+
+    options.orientation = layout.pop('orientation')
+    for name, value in sorted(layout.items()):
+        add_opt(options, name, value)
     add_opt(options, 'notch_height', notch_height)
     add_opt(options, 'notch_width1', notch_width1)
     add_opt(options, 'notch_width2', notch_width2)
 
-    # as we don't draw anything in the final border, it shouldn't count towards how many tabs we can fit
-    # so it gets added back in to the page size here
-    numDividersVerticalP = int(
-        (paperheight - 2 * minmarginheight + verticalBorderSpace) /
-        options.dividerHeightReserved)
-    numDividersHorizontalP = int(
-        (paperwidth - 2 * minmarginwidth + horizontalBorderSpace) /
-        options.dividerWidthReserved)
-    numDividersVerticalL = int(
-        (paperwidth - 2 * minmarginwidth + verticalBorderSpace) /
-        options.dividerHeightReserved)
-    numDividersHorizontalL = int(
-        (paperheight - 2 * minmarginheight + horizontalBorderSpace) /
-        options.dividerWidthReserved)
-
-    if ((numDividersVerticalL * numDividersHorizontalL > numDividersVerticalP *
-         numDividersHorizontalP) and not fixedMargins):
-        add_opt(options, 'numDividersVertical', numDividersVerticalL)
-        add_opt(options, 'numDividersHorizontal', numDividersHorizontalL)
-        add_opt(options, 'paperheight', paperwidth)
-        add_opt(options, 'paperwidth', paperheight)
-        add_opt(options, 'minHorizontalMargin', minmarginheight)
-        add_opt(options, 'minVerticalMargin', minmarginwidth)
-    else:
-        add_opt(options, 'numDividersVertical', numDividersVerticalP)
-        add_opt(options, 'numDividersHorizontal', numDividersHorizontalP)
-        add_opt(options, 'paperheight', paperheight)
-        add_opt(options, 'paperwidth', paperwidth)
-        add_opt(options, 'minHorizontalMargin', minmarginheight)
-        add_opt(options, 'minVerticalMargin', minmarginwidth)
-
-    if not fixedMargins:
-        # dynamically max margins
-        add_opt(options, 'horizontalMargin',
-                (options.paperwidth - options.numDividersHorizontal *
-                 options.dividerWidthReserved + horizontalBorderSpace) / 2)
-        add_opt(options, 'verticalMargin',
-                (options.paperheight - options.numDividersVertical *
-                 options.dividerHeightReserved + verticalBorderSpace) / 2)
-    else:
-        add_opt(options, 'horizontalMargin', minmarginwidth)
-        add_opt(options, 'verticalMargin', minmarginheight)
+
+def count_pages(numCards, layout):
+    perPage = layout['numDividersVertical'] * layout['numDividersHorizontal']
+    if not perPage:
+        return float('inf')
+    return -(-numCards // perPage)
+
+
+def count_layout_pages(cards, options, layout):
+    # the pages the cards take in the layout, with wrappers packed the way
+    # they are when drawn
+    if not (options.wrapper and cards) or options.tabs_only or not layout['numDividersHorizontal']:
+        return count_pages(len(cards), layout)
+    layout_options = copy.copy(options)
+    for name, value in layout.items():
+        setattr(layout_options, name, value)
+    return len(packWrappers(cards, layout_options))
+
+
+def split_languages(options):
+    # one set of options per language to render
+    languages = get_languages(options)
+    if len(languages) == 1:
+        options.language = languages[0]
+        return [options]
+    base, ext = os.path.splitext(options.outfile)
+    language_options = []
+    for language in languages:
+        lang_options = copy.copy(options)
+        lang_options.language = language
+        lang_options.outfile = '{}_{}{}'.format(base, language, ext)
+        language_options.append(lang_options)
+    return language_options
 
 
 def generate(options, data_path):
 
     add_opt(options, 'data_path', data_path)
 
-    cards = read_write_card_data(options)
+    language_options = split_languages(options)
+    if len(language_options) == 1:
+        cards = read_write_card_data(options)
+        render(cards, options, DividerDrawer())
+        return
+
+    # the databases are independent of each other, so read them side by side
+    pool = ThreadPool(len(language_options))
+    try:
+        card_lists = pool.map(read_write_card_data, language_options)
+    finally:
+        pool.close()
+
+    # one drawer for all languages, so fonts are only registered once
+    dd = DividerDrawer()
+    for lang_options, cards in zip(language_options, card_lists):
+        print ':::Generating ' + lang_options.outfile
+        render(cards, lang_options, dd)
+
+
+def read_variants(options):
+    variants = list(options.variant)
+    if options.batch:
+        with open(options.batch) as batchfile:
+            for line in batchfile:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    variants.append(line)
+    return variants
+
+
+def filter_signature(options):
+    # variants that agree on all of these can share the filtered card list
+    values = (getattr(options, o) for o in FILTER_OPTIONS)
+    return tuple(tuple(v) if isinstance(v, list) else v for v in values)
+
+
+def catalog_key(options):
+    # the cards read for options are the same for all options agreeing on
+    # these
+    return options.data_path, options.sqlite_db, options.language
+
+
+def generate_batch(arglist, options, data_path):
+    base, ext = os.path.splitext(options.outfile)
+    variant_options = []
+    for i, variant in enumerate(read_variants(options)):
+        v_options = parse_opts(arglist + shlex.split(variant))
+        add_opt(v_options, 'data_path', data_path)
+        if v_options.outfile == options.outfile:
+            v_options.outfile = '{}_{}{}'.format(base, i + 1, ext)
+        variant_options.extend(split_languages(v_options))
+
+    # shared by all variants, so fonts, images and fitted text sizes are
+    # only worked out once.  Filtering leaves the cards as read untouched,
+    # so each card database is only read once too.
+    dd = DividerDrawer()
+    catalogs = {}
+    filtered = {}
+    timings = []
+    for v_options in variant_options:
+        print ':::Generating ' + v_options.outfile
+        start = time.time()
+        signature = filter_signature(v_options)
+        if signature not in filtered:
+            key = catalog_key(v_options)
+            if key not in catalogs:
+                catalogs[key] = read_write_card_data(v_options)
+            cards = catalogs[key]
+            assert cards, "No cards after reading"
+            filtered[signature] = filter_sort_cards(cards, v_options)
+        draw_cards(filtered[signature], v_options, dd)
+        timings.append((v_options.outfile, time.time() - start))
+
+    for outfile, seconds in timings:
+        print '{:.2f}s {}'.format(seconds, outfile)
+
+
+def render(cards, options, dd):
     assert cards, "No cards after reading"
     cards = filter_sort_cards(cards, options)
+    draw_cards(cards, options, dd)
+
+
+# what a text fitting worker process keeps between chunks of cards
+fit_worker = {}
+
+
+def init_fit_worker(cards, options):
+    fit_worker['cards'] = cards
+    fit_worker['job'] = DividerDrawer().job(options, None)
+
+
+def fit_text(chunk):
+    # the text sizes of a chunk of the cards, as plain data
+    job = fit_worker['job']
+    job.textFits = {}
+    for card in fit_worker['cards'][chunk[0]:chunk[1]]:
+        job.prefitCard(card)
+    return job.textFits
+
+
+def worker_count(options):
+    return options.workers or cpu_count()
+
+
+# below this many dividers, starting the processes and handing them the
+# cards costs more than fitting the texts side by side saves
+PREFIT_POOL_MIN_CARDS = 100
+
+
+def prefit_workers(cards, options):
+    # the number of processes to fit the texts with, or 0 to fit them
+    # while drawing
+    if options.tabs_only:
+        return 0
+    if options.workers is None and len(cards) < PREFIT_POOL_MIN_CARDS:
+        return 0
+    workers = worker_count(options)
+    if workers < 2 or len(cards) < 2 * workers:
+        return 0
+    return workers
+
+
+def prefit_text(cards, options, dd):
+    # Finding the sizes the texts fit at is most of the work of drawing and
+    # does not depend on the page a divider is on, so for many dividers it
+    # is done side by side by other processes first.  Drawing then only
+    # draws, starting from the sizes found.
+    workers = prefit_workers(cards, options)
+    if not workers:
+        return
+    step = max(1, len(cards) // (workers * 4))
+    chunks = [(start, start + step) for start in range(0, len(cards), step)]
+    pool = Pool(workers, init_fit_worker, (cards, options))
+    try:
+        for fits in pool.imap_unordered(fit_text, chunks):
+            dd.textFits.update(fits)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def draw_cards(cards, options, dd):
     assert cards, "No cards after filtering/sorting"
 
     calculate_layout(options, cards)
+    prefit_text(cards, options, dd)
 
     print "Paper dimensions: {:.2f}cm (w) x {:.2f}cm (h)".format(
         options.paperwidth / cm, options.paperheight / cm)
@@ -675,10 +1336,693 @@ def generate(options, data_path):
     print "Margins: {:.2f}cm h, {:.2f}cm v\n".format(
         options.horizontalMargin / cm, options.verticalMargin / cm)
 
-    dd = DividerDrawer()
     dd.draw(cards, options)
 
+    if options.deterministic:
+        print "Content hash: sha256:{}".format(content_hash(options.outfile))
+
+    if options.optimize_size:
+        sizes = pdf_resource_sizes(options.outfile)
+        print "Output size: {:.1f}kB".format(
+            os.path.getsize(options.outfile) / 1024.0)
+        for kind in sorted(sizes):
+            print "  {}: {:.1f}kB".format(kind, sizes[kind] / 1024.0)
+
+
+# card texts smaller than this are hard to read once printed
+READABLE_FONT_SIZE = 6
+
+
+def dry_run(options, data_path, dd=None):
+    # returns a report for each language, as printed.  Fitting the texts is
+    # most of the work; a drawer kept between calls remembers the sizes.
+    add_opt(options, 'data_path', data_path)
+    if dd is None:
+        dd = DividerDrawer()
+    reports = []
+    for lang_options in split_languages(options):
+        start = time.time()
+        cards = read_write_card_data(lang_options)
+        assert cards, "No cards after reading"
+        cards = filter_sort_cards(cards, lang_options)
+        assert cards, "No cards after filtering/sorting"
+        calculate_layout(lang_options, cards)
+
+        prefit_text(cards, lang_options, dd)
+        job = dd.job(lang_options, None)
+        pages = job.paginate(cards)
+        numSides, numPages = job.countPages(pages)
+        if lang_options.num_pages > 0:
+            pages = pages[:lang_options.num_pages]
+
+        sides = job.textSides()
+        card_sizes = []
+        too_small = []
+        for card in (card for pageCards, positions in pages for card in pageCards):
+            fontSize, width, textWidth = job.fitCardTabName(card)
+            sizes = {'name': card.name, 'tab': round(fontSize, 2), 'text': {}}
+            if width > textWidth:
+                too_small.append(u'{}: tab name does not fit at {:.2f}pt'.format(card.name, fontSize))
+            for divider_text, wrapper in sides:
+                textSize = job.prefitText(card, divider_text, wrapper)
+                if textSize is None:
+                    continue
+                sizes['text'][divider_text] = textSize
+                if textSize < READABLE_FONT_SIZE:
+                    too_small.append(u'{}: {} text at {}pt'.format(card.name, divider_text, textSize))
+            card_sizes.append(sizes)
+
+        report = {
+            'outfile': lang_options.outfile,
+            'language': lang_options.language,
+            'pages': numPages,
+            'dividers': len(card_sizes),
+            'dividers_per_page': [len(pageCards) for pageCards, positions in pages],
+            'paper': (round(lang_options.paperwidth / cm, 2), round(lang_options.paperheight / cm, 2)),
+            'cards': card_sizes,
+            'too_small': too_small,
+        }
+        reports.append(report)
+
+        print u'{}: {} pages, {} dividers, up to {} per page on {:.2f}cm x {:.2f}cm paper'.format(
+            report['outfile'], numPages, len(card_sizes), max(report['dividers_per_page']),
+            report['paper'][0], report['paper'][1]).encode('utf-8')
+        for sizes in card_sizes:
+            texts = u''.join(u', {} text {}pt'.format(divider_text, size)
+                             for divider_text, size in sorted(sizes['text'].iteritems()))
+            print u'  {}: tab {:.2f}pt{}'.format(sizes['name'], sizes['tab'], texts).encode('utf-8')
+        for problem in too_small:
+            print u'Too small: {}'.format(problem).encode('utf-8')
+        print '{:.3f}s'.format(time.time() - start)
+    return reports
+
+
+PREVIEW_IGNORED_OPTIONS = ['outfile', 'preview_cache']
+
+
+# everything a preview is drawn from besides the options: the card
+# databases (compiled or not, with their mappings and groups), the images
+# and fonts under the data path, and the code drawing it
+PREVIEW_DATA_DIRS = ['card_db', 'images', 'fonts']
+PREVIEW_DATA_FILES = ['cardlist', 'sqlite_db']
+
+
+def update_digest(digest, path):
+    # adds the contents of a file, or of every file below a directory
+    if os.path.isdir(path):
+        for dirpath, dirnames, fnames in os.walk(path):
+            dirnames.sort()
+            for fname in sorted(fnames):
+                fpath = os.path.join(dirpath, fname)
+                digest.update(os.path.relpath(fpath, path) + '\0')
+                update_digest(digest, fpath)
+    elif os.path.exists(path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), ''):
+                digest.update(block)
+    digest.update('\0')
+
+
+def preview_fingerprint(options):
+    values = sorted((k, v) for k, v in vars(options).iteritems()
+                    if k not in PREVIEW_IGNORED_OPTIONS)
+    digest = hashlib.md5(repr(values))
+    for name in PREVIEW_DATA_DIRS:
+        update_digest(digest, os.path.join(options.data_path, name))
+    for name in PREVIEW_DATA_FILES:
+        if getattr(options, name, None):
+            update_digest(digest, getattr(options, name))
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    for fname in sorted(os.listdir(code_dir)):
+        if fname.endswith('.py'):
+            update_digest(digest, os.path.join(code_dir, fname))
+    return digest.hexdigest()
+
+
+def preview_canvas(options, dpi):
+    return PreviewCanvas(options.paperwidth, options.paperheight, dpi=dpi)
+
+
+def divider_canvas(options, image_format):
+    # a canvas just big enough for the divider drawn at the bottom left
+    origin = (-options.horizontalMargin, -options.verticalMargin)
+    if image_format == 'svg':
+        return SVGPreviewCanvas(options.dividerWidthReserved, options.dividerHeightReserved,
+                                origin=origin)
+    return PreviewCanvas(options.dividerWidthReserved, options.dividerHeightReserved,
+                         dpi=options.preview_dpi, origin=origin)
+
+
+def render_preview_page(args):
+    # runs in a worker process when all pages are previewed
+    cards, options, pageNum = args
+    canvas = preview_canvas(options, options.preview_dpi)
+    DividerDrawer().drawPreviewPage(cards, options, canvas, pageNum)
+    buf = cStringIO.StringIO()
+    canvas.toPIL().save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def contact_sheet(cards, options, dd):
+    # the first page tells us how many there are, the rest are drawn in parallel
+    canvas = preview_canvas(options, options.preview_dpi)
+    numPages = dd.drawPreviewPage(cards, options, canvas, 0)
+    pages = [canvas.toPIL()]
+    if numPages > 1:
+        pool = Pool(min(numPages - 1, cpu_count()))
+        try:
+            pages.extend(Image.open(cStringIO.StringIO(page)) for page in pool.map(
+                render_preview_page, [(cards, options, pageNum) for pageNum in range(1, numPages)]))
+        finally:
+            pool.close()
+    width, height = pages[0].size
+    columns = int(math.ceil(math.sqrt(numPages)))
+    rows = -(-numPages // columns)
+    gap = options.preview_dpi / 8
+    sheet = Image.new('RGB', (columns * (width + gap) + gap, rows * (height + gap) + gap), 'gray')
+    for i, page in enumerate(pages):
+        sheet.paste(page, (gap + (i % columns) * (width + gap), gap + (i // columns) * (height + gap)))
+    return sheet
+
+
+def generate_preview(options, data_path):
+    add_opt(options, 'data_path', data_path)
+    options.language = get_languages(options)[0]
+    outfile = os.path.splitext(options.outfile)[0] + '.png'
+
+    if options.preview_cache:
+        cached = os.path.join(options.preview_cache, preview_fingerprint(options) + '.png')
+        if os.path.exists(cached):
+            shutil.copyfile(cached, outfile)
+            print 'Using cached preview ' + cached
+            return outfile
+
+    cards = read_write_card_data(options)
+    assert cards, "No cards after reading"
+    cards = filter_sort_cards(cards, options)
+    assert cards, "No cards after filtering/sorting"
+    calculate_layout(options, cards)
+
+    dd = DividerDrawer()
+    if options.preview_card:
+        matching = [c for c in cards if c.name.lower() == options.preview_card.lower()]
+        assert matching, u'No card named "{}" in the selected cards'.format(options.preview_card)
+        canvas = divider_canvas(options, 'png')
+        dd.drawPreviewDivider(matching[0], options, canvas)
+        image = canvas.toPIL()
+    elif options.preview == 0:
+        image = contact_sheet(cards, options, dd)
+    else:
+        canvas = preview_canvas(options, options.preview_dpi)
+        numPages = dd.drawPreviewPage(cards, options, canvas, options.preview - 1)
+        print 'Page {} of {}'.format(options.preview, numPages)
+        image = canvas.toPIL()
+
+    image.save(outfile)
+    print 'Wrote preview ' + outfile
+    if options.preview_cache:
+        if not os.path.isdir(options.preview_cache):
+            os.makedirs(options.preview_cache)
+        shutil.copyfile(outfile, cached)
+    return outfile
+
+
+# options that make no difference to how a single divider looks
+TILE_IGNORED_OPTIONS = PREVIEW_IGNORED_OPTIONS + FILTER_OPTIONS + ['tiles', 'workers']
+TILE_NAME = re.compile(r'^[0-9a-f]{32}\.(png|svg)$')
+
+
+def tile_layout(options):
+    values = sorted((k, v) for k, v in vars(options).iteritems()
+                    if k not in TILE_IGNORED_OPTIONS)
+    return repr(values)
+
+
+def tile_name(card, layout, image_format):
+    content = json.dumps(card, cls=Card.CompiledCardJSONEncoder, sort_keys=True)
+    key = hashlib.md5(layout + type(card).__name__ + content).hexdigest()
+    return key + '.' + image_format
+
+
+# what a --tiles worker process keeps between tiles
+tile_worker = {}
+
+
+def init_tile_worker(options):
+    tile_worker['options'] = options
+    tile_worker['drawer'] = DividerDrawer()
+
+
+def render_tile(args):
+    card, fname = args
+    options = tile_worker['options']
+    canvas = divider_canvas(options, options.tile_format)
+    tile_worker['drawer'].drawPreviewDivider(card, options, canvas)
+    # written under another name first, so a tile that is there is complete
+    tmpname = fname + '.tmp'
+    if options.tile_format == 'svg':
+        canvas.saveSVG(tmpname)
+    else:
+        canvas.toPIL().save(tmpname, 'PNG')
+    os.rename(tmpname, fname)
+
+
+def generate_tiles(options, data_path):
+    add_opt(options, 'data_path', data_path)
+    options.language = get_languages(options)[0]
+    start = time.time()
+
+    cards = read_write_card_data(options)
+    assert cards, "No cards after reading"
+    cards = filter_sort_cards(cards, options)
+    assert cards, "No cards after filtering/sorting"
+    calculate_layout(options, cards)
+
+    if not os.path.isdir(options.tiles):
+        os.makedirs(options.tiles)
+    layout = tile_layout(options)
+    index = []
+    todo = []
+    for card in cards:
+        fname = tile_name(card, layout, options.tile_format)
+        path = os.path.join(options.tiles, fname)
+        if not os.path.exists(path) and fname not in (tile['file'] for tile in index):
+            todo.append((card, path))
+        index.append({'name': card.name, 'cardset': card.cardset, 'file': fname})
+
+    workers = worker_count(options)
+    if workers > 1 and len(todo) > 1:
+        pool = Pool(min(workers, len(todo)), init_tile_worker, (options,))
+        try:
+            pool.map(render_tile, todo, max(1, len(todo) // (workers * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_tile_worker(options)
+        for tile in todo:
+            render_tile(tile)
+
+    wanted = set(tile['file'] for tile in index)
+    for fname in os.listdir(options.tiles):
+        if TILE_NAME.match(fname) and fname not in wanted:
+            os.remove(os.path.join(options.tiles, fname))
+    with open(os.path.join(options.tiles, 'index.json'), 'w') as indexfile:
+        json.dump(index, indexfile, indent=4)
+
+    print 'Rendered {} of {} tiles in {:.2f}s'.format(len(todo), len(index), time.time() - start)
+    return index
+
+
+def watch_snapshot(data_path, languages):
+    # every file the output is made from, with the language it belongs to
+    # (None for the images shared by all languages) and its modification time
+    files = {}
+    for language in languages:
+        data_dir = os.path.join(data_path, "card_db", language)
+        for name in os.listdir(data_dir):
+            fname = os.path.join(data_dir, name)
+            files[fname] = (language, os.path.getmtime(fname))
+    image_dir = os.path.join(data_path, "images")
+    for name in os.listdir(image_dir):
+        fname = os.path.join(image_dir, name)
+        files[fname] = (None, os.path.getmtime(fname))
+    return files
+
+
+def changed_languages(before, after):
+    # languages of the files that differ between two snapshots
+    return set((after.get(fname) or before.get(fname))[0]
+               for fname in set(before) | set(after)
+               if before.get(fname) != after.get(fname))
+
+
+def watch(options, data_path, interval=0.5):
+    add_opt(options, 'data_path', data_path)
+    language_options = split_languages(options)
+    languages = [lang_options.language for lang_options in language_options]
+
+    # kept for the whole session, so fonts and fitted text sizes are only
+    # worked out once
+    dd = DividerDrawer()
+
+    def rebuild(changed):
+        for lang_options in language_options:
+            if lang_options.language not in changed:
+                continue
+            print ':::Generating ' + lang_options.outfile
+            start = time.time()
+            try:
+                cards = read_write_card_data(lang_options)
+                render(cards, copy.copy(lang_options), dd)
+            except Exception:
+                # most likely a file saved half way through an edit; keep
+                # watching for the next change
+                traceback.print_exc()
+            else:
+                print '{:.2f}s {}'.format(time.time() - start, lang_options.outfile)
+
+    before = watch_snapshot(data_path, languages)
+    rebuild(set(languages))
+    print 'Watching for changes, press Ctrl-C to stop'
+    try:
+        while True:
+            time.sleep(interval)
+            after = watch_snapshot(data_path, languages)
+            if after == before:
+                continue
+            # wait for the editor to finish writing before rebuilding
+            settled = after
+            while True:
+                time.sleep(interval)
+                after = watch_snapshot(data_path, languages)
+                if after == settled:
+                    break
+                settled = after
+            changed = changed_languages(before, after)
+            if None in changed:
+                # images are used by every language
+                dd.forgetImages()
+                changed = set(languages)
+            before = after
+            rebuild(changed)
+    except KeyboardInterrupt:
+        pass
+
+
+def read_cardlist(fname):
+    with open(fname) as cardfile:
+        return [line.strip() for line in cardfile if line.strip()]
+
+
+def safe_file_name(name):
+    # a name from a manifest or the card database made fit to be part of a
+    # file name: no directories, nothing hidden and no going up
+    parts = re.split(r'[\\/:*?"<>|\x00-\x1f]+', name)
+    name = '_'.join(part for part in parts if part.strip(' .'))
+    return name.strip(' .') or '_'
+
+
+def read_kingdoms(manifest):
+    # yields (name, card names) for every card list of a --kingdoms manifest
+    if os.path.isdir(manifest):
+        for fname in sorted(os.listdir(manifest)):
+            yield (os.path.splitext(fname)[0],
+                   read_cardlist(os.path.join(manifest, fname)))
+        return
+    with codecs.open(manifest, 'r', 'utf-8') as manifestfile:
+        for i, line in enumerate(manifestfile):
+            if not line.strip():
+                continue
+            kingdom = json.loads(line)
+            if 'cardlist' in kingdom:
+                cardlist = os.path.join(os.path.dirname(manifest), kingdom['cardlist'])
+                names = read_cardlist(cardlist)
+            else:
+                names = kingdom['cards']
+            yield kingdom.get('name', str(i + 1)), names
+
+
+# what a --kingdoms worker process keeps between card lists
+kingdom_worker = {}
+
+
+def init_kingdom_worker(catalog, options):
+    kingdom_worker['catalog'] = catalog
+    kingdom_worker['options'] = options
+    kingdom_worker['drawer'] = DividerDrawer()
+
+
+def render_kingdom(kingdom):
+    outfile, names = kingdom
+    options = copy.copy(kingdom_worker['options'])
+    cards, unknown = select_cards(kingdom_worker['catalog'], names, options)
+    if cards:
+        options.outfile = outfile
+        if not hasattr(options, 'paperwidth'):
+            calculate_layout(options, cards)
+        kingdom_worker['drawer'].draw(cards, options)
+    return outfile, len(cards), unknown
+
+
+def generate_kingdoms(options, data_path):
+    add_opt(options, 'data_path', data_path)
+    options.language = get_languages(options)[0]
+    start = time.time()
+
+    # the catalog every card list picks its cards from, in print order
+    catalog = read_write_card_data(options)
+    assert catalog, "No cards after reading"
+    catalog = filter_sort_cards(catalog, options)
+    if not options.wrapper and options.orientation != "auto":
+        # the same for every card list, so only worked out once
+        calculate_layout(options, catalog)
+
+    base, ext = os.path.splitext(options.outfile)
+    kingdoms = [(u'{}_{}{}'.format(base, safe_file_name(name), ext), names)
+                for name, names in read_kingdoms(options.kingdoms)]
+
+    workers = worker_count(options)
+    if workers > 1 and len(kingdoms) > 1:
+        pool = Pool(min(workers, len(kingdoms)), init_kingdom_worker, (catalog, options))
+        try:
+            results = pool.imap_unordered(render_kingdom, kingdoms,
+                                          max(1, len(kingdoms) // (workers * 4)))
+            results = list(results)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_kingdom_worker(catalog, options)
+        results = [render_kingdom(kingdom) for kingdom in kingdoms]
+
+    for outfile, numCards, unknown in sorted(results):
+        if unknown:
+            print u'{}: unknown card(s) {}'.format(outfile, u', '.join(unknown)).encode('utf-8')
+        if not numCards:
+            print u'{}: no cards, nothing written'.format(outfile).encode('utf-8')
+    elapsed = time.time() - start
+    print 'Rendered {} card lists in {:.2f}s ({:.1f} per second)'.format(
+        len(kingdoms), elapsed, len(kingdoms) / elapsed)
+    return results
+
+
+class RenderRequest(object):
+    # A PDF being rendered by a RenderPool.  get() waits for the PDF bytes,
+    # and callbacks added with add_done_callback() are called from the
+    # rendering thread once it is done, so an event loop can be told with
+    # its own thread safe call.  The same goes for progress (see
+    # DividerDrawer.draw).
+
+    def __init__(self, options, progress=None):
+        self.options = options
+        self.progress = progress
+        self.cancelEvent = threading.Event()
+        self.doneEvent = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.finished = False
+        self.pdf = None
+        self.error = None
+
+    def cancel(self):
+        # a request still waiting is dropped, a running one stops after the
+        # divider being drawn
+        self.cancelEvent.set()
+
+    def cancelled(self):
+        return self.cancelEvent.is_set()
+
+    def done(self):
+        return self.doneEvent.is_set()
+
+    def add_done_callback(self, fn):
+        with self.lock:
+            if not self.finished:
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def finish(self, pdf=None, error=None):
+        with self.lock:
+            self.pdf = pdf
+            self.error = error
+            self.finished = True
+        for fn in self.callbacks:
+            fn(self)
+        # only now, so callbacks have been called by the time get() returns
+        self.doneEvent.set()
+
+    def get(self, timeout=None):
+        if not self.doneEvent.wait(timeout):
+            raise TimeoutError()
+        if self.error is not None:
+            raise self.error
+        return self.pdf
+
+
+class RenderPool(object):
+    # Renders PDFs in memory for callers that cannot wait for them, such as
+    # a web service.  At most workers PDFs are drawn at once, all with one
+    # shared DividerDrawer, and each language is only read once.
+
+    def __init__(self, data_path, workers=4):
+        self.data_path = data_path
+        self.pool = ThreadPool(workers)
+        self.drawer = DividerDrawer()
+        self.catalogs = {}
+        self.catalogLock = threading.Lock()
+
+    def submit(self, arglist, progress=None):
+        # arglist is the same as for the command line; the outfile is ignored
+        options = parse_opts(arglist)
+        add_opt(options, 'data_path', self.data_path)
+        options.language = get_languages(options)[0]
+        request = RenderRequest(options, progress)
+        self.pool.apply_async(self.render, (request,))
+        return request
+
+    def dry_run(self, arglist):
+        # the --dry-run report, straight away; the text sizes found are
+        # shared with the renders
+        return dry_run(parse_opts(arglist), self.data_path, self.drawer)
+
+    def catalog(self, options):
+        key = catalog_key(options)
+        with self.catalogLock:
+            if key not in self.catalogs:
+                self.catalogs[key] = read_write_card_data(options)
+            return self.catalogs[key]
+
+    def render(self, request):
+        try:
+            if request.cancelled():
+                raise RenderCancelled()
+            options = request.options
+            cards = self.catalog(options)
+            assert cards, "No cards after reading"
+            cards = filter_sort_cards(cards, options)
+            assert cards, "No cards after filtering/sorting"
+            calculate_layout(options, cards)
+            options.outfile = cStringIO.StringIO()
+            self.drawer.draw(cards, options, request.cancelEvent, progress=request.progress)
+            request.finish(pdf=options.outfile.getvalue())
+        except Exception as e:
+            request.finish(error=e)
+
+    def close(self):
+        # waits for the requests already submitted
+        self.pool.close()
+        self.pool.join()
+
+
+def split_groups(cards, options, dd):
+    # (name, cards, tab side of the first divider) for each --split-by group
+    kind, size = options.split_by
+    if kind == 'expansion':
+        groups = []
+        byExpansion = {}
+        for card in cards:
+            if card.cardset not in byExpansion:
+                byExpansion[card.cardset] = []
+                groups.append((card.cardset, byExpansion[card.cardset], None))
+            byExpansion[card.cardset].append(card)
+        return groups
+
+    job = dd.job(options, None)
+    pages = job.paginate(cards)
+    odd = job.startOdd()
+    groups = []
+    for first in range(0, len(pages), size):
+        groupPages = pages[first:first + size]
+        groupCards = [card for pageCards, positions in groupPages for card in pageCards]
+        groups.append(('pages{}-{}'.format(first + 1, first + len(groupPages)), groupCards, odd))
+        # every front flips the side of the next tab
+        if len(groupCards) % 2:
+            odd = not odd
+    return groups
+
+
+# what a --split-by worker process keeps between groups
+split_worker = {}
+
+
+def init_split_worker(options):
+    split_worker['options'] = options
+    split_worker['drawer'] = DividerDrawer()
+
+
+def render_split_group(group):
+    outfile, cards, odd = group
+    options = copy.copy(split_worker['options'])
+    options.outfile = outfile
+    split_worker['drawer'].draw(cards, options, odd=odd)
+    return outfile
+
+
+def generate_split(options, data_path):
+    add_opt(options, 'data_path', data_path)
+    manifests = []
+    for lang_options in split_languages(options):
+        start = time.time()
+        cards = read_write_card_data(lang_options)
+        assert cards, "No cards after reading"
+        cards = filter_sort_cards(cards, lang_options)
+        assert cards, "No cards after filtering/sorting"
+        # the same layout for every group
+        calculate_layout(lang_options, cards)
+
+        base, ext = os.path.splitext(lang_options.outfile)
+        groups = split_groups(cards, lang_options, DividerDrawer())
+        jobs = [(u'{}_{}{}'.format(base, safe_file_name(name), ext), groupCards, odd)
+                for name, groupCards, odd in groups]
+        workers = worker_count(options)
+        if workers > 1 and len(jobs) > 1:
+            pool = Pool(min(workers, len(jobs)), init_split_worker, (lang_options,))
+            try:
+                pool.map(render_split_group, jobs, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            init_split_worker(lang_options)
+            for job in jobs:
+                render_split_group(job)
+
+        manifest = []
+        for (name, groupCards, odd), (outfile, _, _) in zip(groups, jobs):
+            entry = {'group': name, 'file': outfile, 'cards': len(groupCards)}
+            if options.deterministic:
+                entry['sha256'] = content_hash(outfile)
+            manifest.append(entry)
+            print u'{}: {} dividers'.format(outfile, len(groupCards)).encode('utf-8')
+        manifest_file = base + '_manifest.json'
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=4)
+        print 'Wrote {} files in {:.2f}s, listed in {}'.format(
+            len(jobs), time.time() - start, manifest_file)
+        manifests.append(manifest_file)
+    return manifests
+
 
 def main(arglist, data_path):
     options = parse_opts(arglist)
+    if options.compile_db:
+        return compile_card_db(options, data_path)
+    if options.build_images:
+        return build_images(options, data_path)
+    if options.dry_run:
+        return dry_run(options, data_path)
+    if options.kingdoms:
+        return generate_kingdoms(options, data_path)
+    if options.tiles:
+        return generate_tiles(options, data_path)
+    if options.split_by:
+        return generate_split(options, data_path)
+    if options.preview is not None or options.preview_card:
+        return generate_preview(options, data_path)
+    if options.batch or options.variant:
+        return generate_batch(arglist, options, data_path)
+    if options.watch:
+        return watch(options, data_path)
     return generate(options, data_path)
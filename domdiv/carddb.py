@@ -0,0 +1,101 @@
+import os
+import json
+import errno
+import sqlite3
+
+from cards import Card
+
+# One database for all languages.  The cards are kept as the JSON they are
+# read from, with the columns searched on next to them and a full text
+# index over their texts.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cards (
+    id INTEGER PRIMARY KEY,
+    language TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    cardset TEXT NOT NULL,
+    cost TEXT,
+    cost_value INTEGER,
+    json TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cards_language ON cards (language, position);
+CREATE INDEX IF NOT EXISTS cards_cardset ON cards (language, cardset);
+CREATE INDEX IF NOT EXISTS cards_cost ON cards (language, cost_value);
+CREATE TABLE IF NOT EXISTS card_types (
+    card_id INTEGER NOT NULL,
+    type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS card_types_type ON card_types (type, card_id);
+CREATE INDEX IF NOT EXISTS card_types_card ON card_types (card_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS cards_text USING fts4 (name, description, extra);
+CREATE TABLE IF NOT EXISTS mappings (
+    language TEXT PRIMARY KEY,
+    json TEXT NOT NULL
+);
+"""
+
+
+def connect(dbfile, create=True):
+    # sqlite makes an empty database of a file that is not there, which is
+    # only wanted when storing cards
+    if not create and not os.path.exists(dbfile):
+        raise IOError(errno.ENOENT, 'No such card database', dbfile)
+    conn = sqlite3.connect(dbfile)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def store_language(conn, language, cards, language_mapping=None):
+    # replaces all cards of the language; the mapping is kept if not given
+    with conn:
+        ids = "SELECT id FROM cards WHERE language = ?"
+        conn.execute("DELETE FROM cards_text WHERE docid IN (%s)" % ids, (language,))
+        conn.execute("DELETE FROM card_types WHERE card_id IN (%s)" % ids, (language,))
+        conn.execute("DELETE FROM cards WHERE language = ?", (language,))
+        for position, card in enumerate(cards):
+            cursor = conn.execute(
+                "INSERT INTO cards (language, position, name, cardset, cost, cost_value, json)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (language, position, card.name, card.cardset, card.cost, card.getCostValue(),
+                 json.dumps(card, cls=Card.CompiledCardJSONEncoder, ensure_ascii=False,
+                            sort_keys=True)))
+            conn.executemany("INSERT INTO card_types (card_id, type) VALUES (?, ?)",
+                             [(cursor.lastrowid, cardtype) for cardtype in card.types])
+            conn.execute("INSERT INTO cards_text (docid, name, description, extra) VALUES (?, ?, ?, ?)",
+                         (cursor.lastrowid, card.name, card.description, card.extra))
+        if language_mapping is not None:
+            conn.execute("INSERT OR REPLACE INTO mappings (language, json) VALUES (?, ?)",
+                         (language, json.dumps(language_mapping, ensure_ascii=False)))
+
+
+def query_cards(conn, language, cardset=None, cardtype=None, cost=None, text=None):
+    # the cards of a language, in database order, optionally only those of
+    # a set, with a type, costing cost coins or whose texts match the full
+    # text query text
+    sql = "SELECT json FROM cards WHERE language = ?"
+    args = [language]
+    if cardset is not None:
+        sql += " AND cardset = ?"
+        args.append(cardset)
+    if cost is not None:
+        sql += " AND cost_value = ?"
+        args.append(cost)
+    if cardtype is not None:
+        sql += " AND id IN (SELECT card_id FROM card_types WHERE type = ?)"
+        args.append(cardtype)
+    if text is not None:
+        sql += " AND id IN (SELECT docid FROM cards_text WHERE cards_text MATCH ?)"
+        args.append(text)
+    sql += " ORDER BY position"
+    return [Card.decode_json(json.loads(row[0])) for row in conn.execute(sql, args)]
+
+
+def read_language(conn, language):
+    # returns all cards of the language and its mapping, or None for both
+    # if the database does not hold the language
+    row = conn.execute("SELECT json FROM mappings WHERE language = ?", (language,)).fetchone()
+    cards = query_cards(conn, language)
+    if not cards:
+        return None, None
+    return cards, json.loads(row[0]) if row else {}
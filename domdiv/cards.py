@@ -1,5 +1,7 @@
+import copy
 import json
 import os
+import re
 from reportlab.lib.units import cm
 
 
@@ -24,10 +26,10 @@ setImages = {
     'empires extras': 'empires_set.png'
 }
 promoImages = {
-    'walled village': 'walled_village_set.png',
+    'walled_village': 'walled_village_set.png',
     'stash': 'stash_set.png',
     'governor': 'governor_set.png',
-    'black market': 'black_market_set.png',
+    'black_market': 'black_market_set.png',
     'envoy': 'envoy_set.png',
     'prince': 'prince_set.png',
     'summon': 'summon_set.png'
@@ -52,57 +54,112 @@ setTextIcons = {
 }
 
 promoTextIcons = {
-    'walled village': '',
+    'walled_village': '',
     'stash': '',
     'governor': '',
-    'black market': '',
+    'black_market': '',
     'envoy': '',
     'prince': ''
 }
 
-language_mapping = None
+# inline images in the card text, as (pattern, replacement) pairs.  The
+# replacements are templates still needing the path of each image, named by
+# its file, and the image widths for the font size (width, vpwidth) filled
+# in (see InlineImageValues in draw.py).
+inlineImages = [
+    ('(\d+)\s(c|C)oin(s)?',
+     "<img src='%(coin_small_\\1.png)s' width=%(width)d height='100%%' valign='middle'/>"),
+    ('\?\s(c|C)oin(s)?',
+     "<img src='%(coin_small_question.png)s' width=%(width)d height='100%%' valign='middle'/>"),
+    ('empty\s(c|C)oin(s)?',
+     "<img src='%(coin_small_empty.png)s' width=%(width)d height='100%%' valign='middle'/>"),
+    ('\<VP\>',
+     "<img src='%(victory_emblem.png)s' width=%(vpwidth)d height='120%%' valign='middle'/>"),
+    ('(\d+)\sDebt',
+     "<img src='%(debt_\\1.png)s' width=%(width)d height='105%%' valign='middle'/>&thinsp;"),
+    ('Debt',
+     "<img src='%(debt.png)s' width=%(width)d height='105%%' valign='middle'/>&thinsp;"),
+    ('Potion',
+     "<img src='%(potion_small.png)s' width=%(width)d height='100%%' valign='middle'/>"),
+]
+
+
+def cardId(englishName):
+    # the id of a card in every language, made from its English name
+    return re.sub(r'[^a-z0-9]+', '_', englishName.lower()).strip('_')
+
+
+def inlineImageTemplate(text):
+    text = text.replace('%', '%%')
+    for pattern, replace in inlineImages:
+        text = re.sub(pattern, replace, text)
+    return text
 
 
 class Card(object):
 
-    language_mapping = None
+    # replaced per card by the mapping of the language the card was read in
+    language_mapping = {}
+
+    # set by bindAssets() and compile() together with the values below them
+    bound = False
+    compiled = False
+    compiledFields = ['bound', 'set_image', 'set_text', 'tab_image',
+                      'compiled', 'cost_value', 'markup']
 
     class CardJSONEncoder(json.JSONEncoder):
 
         def default(self, obj):
             if isinstance(obj, Card):
-                return obj.__dict__
+                return {k: v for k, v in obj.__dict__.iteritems()
+                        if k != 'language_mapping' and k not in Card.compiledFields}
+            return json.JSONEncoder.default(self, obj)
+
+    class CompiledCardJSONEncoder(json.JSONEncoder):
+
+        def default(self, obj):
+            if isinstance(obj, Card):
+                return {k: v for k, v in obj.__dict__.iteritems()
+                        if k != 'language_mapping'}
             return json.JSONEncoder.default(self, obj)
 
     @staticmethod
     def decode_json(obj):
-        return Card(**obj)
+        compiled = {k: obj.pop(k) for k in Card.compiledFields if k in obj}
+        card = Card(**obj)
+        card.__dict__.update(compiled)
+        return card
 
-    @classmethod
-    def getSetImage(cls, setName, cardName):
+    @staticmethod
+    def getSetImage(setName, cardName, language_mapping, card_id=None):
+        # promo cards are looked up by id, or by the id their name (or its
+        # translation) would have
         if setName in setImages:
             return setImages[setName]
-        if cardName.lower() in promoImages:
-            return promoImages[cardName.lower()]
-        if setName in cls.language_mapping:
-            trans = cls.language_mapping[setName]
+        card_id = card_id or cardId(cardName)
+        if card_id in promoImages:
+            return promoImages[card_id]
+        if setName in language_mapping:
+            trans = language_mapping[setName]
             if trans in setImages:
                 return setImages[trans]
-        if cardName in cls.language_mapping:
-            trans = cls.language_mapping[cardName]
-            if trans.lower() in promoImages:
-                return promoImages[trans.lower()]
+        if cardName in language_mapping:
+            trans = language_mapping[cardName]
+            if cardId(trans) in promoImages:
+                return promoImages[cardId(trans)]
         return None
 
     @classmethod
-    def getSetText(cls, setName, cardName):
+    def getSetText(cls, setName, cardName, card_id=None):
         if setName in setTextIcons:
             return setTextIcons[setName]
-        if cardName.lower() in promoTextIcons:
-            return promoTextIcons[cardName.lower()]
+        card_id = card_id or cardId(cardName)
+        if card_id in promoTextIcons:
+            return promoTextIcons[card_id]
         return None
 
-    def __init__(self, name, cardset, types, cost, description='', potcost=0, debtcost=0, extra='', count=-1):
+    def __init__(self, name, cardset, types, cost, description='', potcost=0, debtcost=0, extra='', count=-1,
+                 card_id=None):
         self.name = name.strip()
         self.cardset = cardset.strip()
         self.types = types
@@ -111,6 +168,8 @@ class Card(object):
         self.debtcost = debtcost
         self.description = description
         self.extra = extra
+        # the same in every language; None for cards not matched up yet
+        self.card_id = card_id
         if count < 0:
             self.count = getType(self.types).getTypeDefaultCardCount()
         else:
@@ -129,6 +188,44 @@ class Card(object):
     def getType(self):
         return getType(self.types)
 
+    def overlay(self, **changes):
+        # a copy with some values changed, leaving the card itself as read
+        # from the database for other jobs; the copy binds its own assets
+        card = copy.copy(self)
+        card.__dict__.update(changes)
+        card.__dict__.pop('bound', None)
+        return card
+
+    def getCostValue(self):
+        # the number the cost starts with, if any ("4*", "3+")
+        if self.compiled:
+            return self.cost_value
+        cost = re.match('\d+', self.cost or '')
+        return int(cost.group()) if cost else None
+
+    def textTemplate(self, text):
+        if self.compiled and text in self.markup:
+            return self.markup[text]
+        return inlineImageTemplate(text)
+
+    def bindAssets(self):
+        # resolve the images the card is drawn with, once the card list is
+        # final, rather than for every side of every divider
+        self.set_image = Card.getSetImage(self.cardset, self.name,
+                                          self.language_mapping, self.card_id)
+        self.set_text = Card.getSetText(self.cardset, self.name, self.card_id)
+        self.tab_image = self.getType().getNoCoinTabImageFile()
+        self.bound = True
+
+    def compile(self):
+        # work out up front what would otherwise be worked out every time
+        # the card is drawn
+        self.bindAssets()
+        self.cost_value = self.getCostValue()
+        texts = self.description.split('\n') + [self.extra]
+        self.markup = {text: inlineImageTemplate(text) for text in texts if text}
+        self.compiled = True
+
     def __repr__(self):
         return '"' + self.name + '"'
 
@@ -152,17 +249,27 @@ class Card(object):
         return what in self.getType().getTypeNames()
 
     def setImage(self):
-        setImage = Card.getSetImage(self.cardset, self.name)
+        if self.bound:
+            return self.set_image
+        setImage = Card.getSetImage(self.cardset, self.name,
+                                    self.language_mapping, self.card_id)
         if setImage is None and self.cardset != 'base':
-            print 'warning, no set image for set "{}" card "{}"'.format(self.cardset, self.name)
+            print u'warning, no set image for set "{}" card "{}"'.format(self.cardset, self.name).encode('utf-8')
         return setImage
 
     def setTextIcon(self):
-        setTextIcon = Card.getSetText(self.cardset, self.name)
+        if self.bound:
+            return self.set_text
+        setTextIcon = Card.getSetText(self.cardset, self.name, self.card_id)
         if setTextIcon is None and self.cardset != 'base':
-            print 'warning, no set text for set "{}" card "{}"'.format(self.cardset, self.name)
+            print u'warning, no set text for set "{}" card "{}"'.format(self.cardset, self.name).encode('utf-8')
         return setTextIcon
 
+    def tabImage(self):
+        if self.bound:
+            return self.tab_image
+        return self.getType().getNoCoinTabImageFile()
+
     def isBlank(self):
         return False
 
@@ -176,6 +283,36 @@ class BlankCard(Card):
         return True
 
 
+class CardIndex(object):
+    # The ids of the cards of every language by name, and their names by
+    # id, so that a card named in one language is found in any other
+    # without searching.
+
+    def __init__(self):
+        self.ids = {}       # (language, name) -> id
+        self.anyIds = {}    # name -> the ids it has in any language
+        self.names = {}     # (id, language) -> name
+
+    def add(self, language, name, card_id):
+        if not card_id:
+            return
+        self.ids[(language, name)] = card_id
+        self.anyIds.setdefault(name, set()).add(card_id)
+        self.names[(card_id, language)] = name
+
+    def cardId(self, name, language):
+        # the id of the card with the name in the language, else in English,
+        # else in whichever language has a card of that name, if only one
+        # card is called that
+        card_id = self.ids.get((language, name)) or self.ids.get(('en_us', name))
+        if card_id is None and len(self.anyIds.get(name, ())) == 1:
+            card_id = next(iter(self.anyIds[name]))
+        return card_id
+
+    def cardName(self, card_id, language):
+        return self.names.get((card_id, language))
+
+
 class CardType(object):
 
     def __init__(self, typeNames, tabImageFile, defaultCardCount=10, tabTextHeightOffset=0, tabCostHeightOffset=-1):
@@ -184,6 +321,11 @@ class CardType(object):
         self.tabTextHeightOffset = tabTextHeightOffset
         self.tabCostHeightOffset = tabCostHeightOffset
         self.defaultCardCount = defaultCardCount
+        if tabImageFile:
+            base, ext = os.path.splitext(tabImageFile)
+            self.noCoinTabImageFile = base + '_nc' + ext
+        else:
+            self.noCoinTabImageFile = None
 
     def getTypeDefaultCardCount(self):
         return self.defaultCardCount
@@ -197,9 +339,7 @@ class CardType(object):
         return self.tabImageFile
 
     def getNoCoinTabImageFile(self):
-        if not self.tabImageFile:
-            return None
-        return ''.join(os.path.splitext(self.tabImageFile)[0] + '_nc' + os.path.splitext(self.tabImageFile)[1])
+        return self.noCoinTabImageFile
 
     def getTabTextHeightOffset(self):
         return self.tabTextHeightOffset
@@ -254,3 +394,15 @@ cardTypes = [
 ]
 
 cardTypes = dict(((c.getTypeNames(), c) for c in cardTypes))
+
+# changed whenever compiled cards hold something new or have something
+# worked out differently, so that databases compiled before are not used
+COMPILED_FORMAT = 1
+
+
+def compiledTables():
+    # what compiled cards are made from besides the cards themselves: the
+    # format and the tables bindAssets() and compile() look things up in
+    return repr((COMPILED_FORMAT, sorted(setImages.items()), sorted(promoImages.items()),
+                 sorted(setTextIcons.items()), sorted(promoTextIcons.items()), inlineImages,
+                 sorted((names, t.getNoCoinTabImageFile()) for names, t in cardTypes.items())))
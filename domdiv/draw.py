@@ -1,8 +1,15 @@
 import os
 import re
 import sys
+import copy
+import time
+import collections
+import hashlib
+import threading
 
+from reportlab import rl_config
 from reportlab.lib.units import cm
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfbase import pdfmetrics
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.platypus import Paragraph
@@ -19,28 +26,173 @@ def split(l, n):
     yield l[i:]
 
 
+def packWrappers(cards, options):
+    # Wrappers are as tall as their own stack of cards, so rather than
+    # giving each the slot of the tallest stack, fill the page with rows
+    # that are only as tall as the tallest wrapper in that row.
+    # Returns the cards of each page with the height of each card
+    # above the bottom margin.  The slot size comes from the layout, which
+    # may have been worked out for more cards than these.
+    baseHeight = options.dividerHeightReserved - 2 * options.maxStackHeight
+    gap = options.vertical_gap * cm
+    top = options.paperheight - options.minTopBottomMargin - options.verticalMargin
+    bottom = options.minTopBottomMargin - options.verticalMargin
+
+    pages = []
+    pageCards, positions = [], []
+    y = top
+    for row in split(cards, options.numDividersHorizontal):
+        height = baseHeight + 2 * max(c.getStackHeight(options.thickness) for c in row)
+        # the gap below the last row is not needed
+        if pageCards and y - height + gap < bottom:
+            pages.append((pageCards, positions))
+            pageCards, positions = [], []
+            y = top
+        y -= height
+        pageCards.extend(row)
+        positions.extend([y] * len(row))
+    pages.append((pageCards, positions))
+    return pages
+
+
+class A85Setting(object):
+    # rl_config.useA85 is global to reportlab, so jobs that want it changed
+    # wait for jobs that want it left alone and the other way round.  Jobs
+    # hold the setting from creating their canvas until it is saved, as
+    # reportlab reads it while drawing images and writing the file.
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active = 0
+        self.useA85 = None
+        # reportlab's own setting, kept here as the global may be changed by
+        # another job whenever this one looks at it
+        self.default = rl_config.useA85
+
+    def use(self, useA85=None):
+        # None asks for reportlab's own setting
+        if useA85 is None:
+            useA85 = self.default
+        with self.condition:
+            while self.active and self.useA85 != useA85:
+                self.condition.wait()
+            if not self.active:
+                self.useA85 = useA85
+                rl_config.useA85 = useA85
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            if not self.active:
+                rl_config.useA85 = self.default
+                self.condition.notify_all()
+
+
+a85Setting = A85Setting()
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+class InlineImageValues(object):
+    # What the inline image templates of a card text (see cards.py) are
+    # filled in with.  Images are named by file, and go through imageFile
+    # like all others, so each distinct image is embedded once.
+
+    def __init__(self, drawer, fontsize):
+        self.drawer = drawer
+        self.fontsize = fontsize
+
+    def __getitem__(self, key):
+        if key == 'width':
+            return self.fontsize * 1.2
+        if key == 'vpwidth':
+            return self.fontsize * 1.5
+        if key == 'path':
+            # the image directory, for texts compiled before images were
+            # named by file
+            return self.drawer.imagePath
+        if key == 'empty':
+            key = 'coin_small_empty.png'
+        return self.drawer.imageFile(key)
+
+
 class DividerDrawer(object):
+    # A drawer can be kept for many jobs, and shared by threads drawing at
+    # the same time: each job draws with its own copy of the drawer (see
+    # job()), holding the options, canvas and tab side of that job, while the
+    # fonts and the caches below are shared by all copies.
+
+    fontLock = threading.Lock()
+
+    # the space left around the text of a divider
+    textHorizontalMargin = .5 * cm
+    textVerticalMargin = .3 * cm
+
     def __init__(self):
         self.odd = True
+        self.options = None
         self.canvas = None
-
-    def registerFonts(self):
-        try:
-            dirn = os.path.join(self.options.data_path, 'fonts')
-            self.fontNameRegular = 'MinionPro-Regular'
-            pdfmetrics.registerFont(TTFont(self.fontNameRegular, os.path.join(
-                dirn, 'MinionPro-Regular.ttf')))
-            self.fontNameBold = 'MinionPro-Bold'
-            pdfmetrics.registerFont(TTFont(self.fontNameBold, os.path.join(
-                dirn, 'MinionPro-Bold.ttf')))
-            self.fontNameOblique = 'MinionPro-Oblique'
-            pdfmetrics.registerFont(TTFont(self.fontNameOblique, os.path.join(
-                dirn, 'MinionPro-It.ttf')))
-        except:
-            print >> sys.stderr, "Warning, Minion Pro Font ttf file not found! Falling back on Times"
-            self.fontNameRegular = 'Times-Roman'
-            self.fontNameBold = 'Times-Bold'
-            self.fontNameOblique = 'Times-Oblique'
+        self.textForms = None
+        self.cancel = None
+        self.progress = None
+        self.progressCounts = None
+        self.progressStart = None
+        self.fontNameRegular = None
+        self.imagePath = None
+        # image file paths, per image directory and --optimize-size
+        self.imageCaches = {}
+        self.imageFiles = None
+        self.imageDigests = None
+        self.imageReaders = None
+        # character widths at size 1 per font, and the widths of tab names
+        self.glyphWidths = {}
+        self.nameMetricsCache = {}
+        # the sizes tried for a tab name, per starting size
+        self.tabNameSizes = {}
+        # fitted text sizes and tab name lines, kept for as long as the
+        # drawer is reused
+        self.tabNameFits = {}
+        self.tabNameLayouts = {}
+        self.textFits = {}
+
+    def registerFonts(self, data_path):
+        with DividerDrawer.fontLock:
+            if self.fontNameRegular is not None:
+                return
+            try:
+                dirn = os.path.join(data_path, 'fonts')
+                fontNames = 'MinionPro-Regular', 'MinionPro-Bold', 'MinionPro-Oblique'
+                pdfmetrics.registerFont(TTFont(fontNames[0], os.path.join(
+                    dirn, 'MinionPro-Regular.ttf')))
+                pdfmetrics.registerFont(TTFont(fontNames[1], os.path.join(
+                    dirn, 'MinionPro-Bold.ttf')))
+                pdfmetrics.registerFont(TTFont(fontNames[2], os.path.join(
+                    dirn, 'MinionPro-It.ttf')))
+            except:
+                print >> sys.stderr, "Warning, Minion Pro Font ttf file not found! Falling back on Times"
+                fontNames = 'Times-Roman', 'Times-Bold', 'Times-Italic'
+            # the regular font name goes last, as other threads check it
+            self.fontNameBold, self.fontNameOblique = fontNames[1:]
+            self.fontNameRegular = fontNames[0]
+
+    def job(self, options, canvas):
+        # a copy of the drawer for drawing one job, sharing fonts and caches
+        if self.fontNameRegular is None:
+            self.registerFonts(options.data_path)
+        job = copy.copy(self)
+        job.options = options
+        job.canvas = canvas
+        job.odd = True
+        job.textForms = None
+        job.cancel = None
+        job.progress = None
+        job.imagePath = self.imageDirectory(options)
+        job.imageFiles, job.imageDigests, job.imageReaders = self.imageCaches.setdefault(
+            (job.imagePath, options.optimize_size), ({}, {}, {}))
+        return job
 
     def wantCentreTab(self, card):
         return (card.isExpansion() and self.options.centre_expansion_dividers) or self.options.tab_side == "centre"
@@ -194,40 +346,68 @@ class DividerDrawer(object):
 
         self.canvas.restoreState()
 
-    def draw(self, cards, options):
-        self.options = options
-
-        self.registerFonts()
-        self.canvas = canvas.Canvas(
-            options.outfile,
-            pagesize=(options.paperwidth, options.paperheight))
-        self.drawDividers(cards)
-        self.canvas.save()
-
-    def add_inline_images(self, text, fontsize):
-        path = os.path.join(self.options.data_path, 'images')
-        replace = '<img src=' "'%s/coin_small_\\1.png'" ' width=%d height=' "'100%%'" ' valign=' "'middle'" '/>'
-        replace = replace % (path, fontsize * 1.2)
-        text = re.sub('(\d+)\s(c|C)oin(s)?', replace, text)
-        replace = '<img src=' "'%s/coin_small_question.png'" ' width=%d height=' "'100%%'" ' valign=' "'middle'" '/>'
-        replace = replace % (path, fontsize * 1.2)
-        text = re.sub('\?\s(c|C)oin(s)?', replace, text)
-        replace = '<img src=' "'%s/coin_small_empty.png'" ' width=%d height=' "'100%%'" ' valign=' "'middle'" '/>'
-        replace = replace % (path, fontsize * 1.2)
-        text = re.sub('empty\s(c|C)oin(s)?', replace, text)
-        replace = '<img src=' "'%s/victory_emblem.png'" ' width=%d height=' "'120%%'" ' valign=' "'middle'" '/>'
-        replace = replace % (path, fontsize * 1.5)
-        text = re.sub('\<VP\>', replace, text)
-        replace = '<img src=' "'%s/debt_\\1.png'" ' width=%d height=' "'105%%'" ' valign=' "'middle'" '/>&thinsp;'
-        replace = replace % (path, fontsize * 1.2)
-        text = re.sub('(\d+)\sDebt', replace, text)
-        replace = '<img src=' "'%s/debt.png'" ' width=%d height=' "'105%%'" ' valign=' "'middle'" '/>&thinsp;'
-        replace = replace % (path, fontsize * 1.2)
-        text = re.sub('Debt', replace, text)
-        replace = '<img src=' "'%s/potion_small.png'" ' width=%d height=' "'100%%'" ' valign=' "'middle'" '/>'
-        replace = replace % (path, fontsize * 1.2)
-        text = re.sub('Potion', replace, text)
-        return text
+    def imageDirectory(self, options):
+        # the copies of the images made for the print resolution by
+        # --build_images, if there are any
+        imagePath = os.path.join(options.data_path, 'images')
+        scaledPath = '{}_{}dpi'.format(imagePath, options.image_dpi)
+        if not options.full_resolution_images and os.path.isdir(scaledPath):
+            return scaledPath
+        return imagePath
+
+    def imageFile(self, img):
+        # paths are worked out once per image for as long as the image
+        # directory and --optimize-size stay the same
+        if img not in self.imageFiles:
+            fname = os.path.join(self.imagePath, img)
+            if self.options.optimize_size:
+                # reportlab embeds an image once per file name, so map files
+                # with identical content onto the first one seen
+                with open(fname, 'rb') as imgfile:
+                    digest = hashlib.md5(imgfile.read()).hexdigest()
+                fname = self.imageDigests.setdefault(digest, fname)
+            self.imageFiles[img] = fname
+        return self.imageFiles[img]
+
+    def imageReader(self, img):
+        # Images inline in the card texts reach reportlab as ImageReaders,
+        # which it names by their pixels rather than their file, so the
+        # same images drawn elsewhere are drawn that way too to be embedded
+        # once.  The pixels are read here, before threads share the reader.
+        if img not in self.imageReaders:
+            reader = ImageReader(self.imageFile(img))
+            reader.getRGBData()
+            self.imageReaders[img] = reader
+        return self.imageReaders[img]
+
+    def forgetImages(self):
+        # the image files changed on disk
+        self.imageCaches = {}
+
+    def draw(self, cards, options, cancel=None, odd=None, progress=None):
+        # cancel is an optional threading.Event, checked after each divider.
+        # odd gives the tab side of the first divider, for cards that carry
+        # on from those in another file.  progress is called as
+        # progress(kind, done, total, elapsed) after each 'divider' (fronts
+        # and backs) and each 'page' drawn.
+        a85Setting.use(0 if options.optimize_size else None)
+        try:
+            job = self.job(options, canvas.Canvas(
+                options.outfile,
+                pagesize=(options.paperwidth, options.paperheight),
+                pageCompression=1 if options.optimize_size else None,
+                invariant=1 if options.deterministic else None))
+            if not options.tabs_only and not options.wrapper:
+                job.textForms = job.planTextForms(cards)
+            job.cancel = cancel
+            job.progress = progress
+            job.drawDividers(cards, odd)
+            job.canvas.save()
+        finally:
+            a85Setting.release()
+
+    def add_inline_images(self, template, fontsize):
+        return template % InlineImageValues(self, fontsize)
 
     def drawOutline(self,
                     card,
@@ -312,7 +492,7 @@ class DividerDrawer(object):
         countHeight = cardIconHeight - 4
 
         self.canvas.drawImage(
-            os.path.join(self.options.data_path, 'images', 'card.png'),
+            self.imageFile('card.png'),
             x,
             countHeight,
             16,
@@ -325,10 +505,19 @@ class DividerDrawer(object):
         self.canvas.drawCentredString(x + 8, countHeight + 4, count)
         return width
 
-    def drawCost(self, card, x, y, costOffset=-1):
-        # base width is 16 (for image) + 2 (1 pt border on each side)
+    def costWidth(self, card):
+        # base width is 16 (for image) + 2 (1 pt border on each side), and
+        # the coin or potion drawn next to it
         width = 18
+        if card.debtcost and card.getCostValue() > 0:
+            width += 16
+        if card.potcost:
+            width += 11
+        return width
 
+    def drawCost(self, card, x, y, costOffset=-1):
+        # the coin and debt are drawn like the same images inline in the card
+        # texts, with the transparency they carry, so each is embedded once
         costHeight = y + costOffset
         coinHeight = costHeight - 5
         potHeight = y - 3
@@ -336,34 +525,31 @@ class DividerDrawer(object):
 
         if card.debtcost:
             self.canvas.drawImage(
-                os.path.join(self.options.data_path, 'images', 'debt.png'),
+                self.imageReader('debt.png'),
                 x,
                 coinHeight,
                 16,
                 16,
                 preserveAspectRatio=True,
-                mask=[255, 255, 255, 255, 255, 255])
+                mask='auto')
             cost = str(card.debtcost)
-            if card.cost != "" and int(card.cost) > 0:
+            if card.getCostValue() > 0:
                 self.canvas.drawImage(
-                    os.path.join(self.options.data_path, 'images',
-                                 'coin_small.png'),
+                    self.imageReader('coin_small.png'),
                     x + 17,
                     coinHeight,
                     16,
                     16,
                     preserveAspectRatio=True,
-                    mask=[255, 255, 255, 255, 255, 255])
+                    mask='auto')
                 self.canvas.setFont(self.fontNameBold, 12)
                 self.canvas.drawCentredString(x + 8 + 17, costHeight,
                                               str(card.cost))
                 self.canvas.setFillColorRGB(0, 0, 0)
-                width += 16
             self.canvas.setFillColorRGB(1, 1, 1)
         else:
             self.canvas.drawImage(
-                os.path.join(self.options.data_path, 'images',
-                             'coin_small.png'),
+                self.imageReader('coin_small.png'),
                 x,
                 coinHeight,
                 16,
@@ -373,42 +559,139 @@ class DividerDrawer(object):
             cost = str(card.cost)
         if card.potcost:
             self.canvas.drawImage(
-                os.path.join(self.options.data_path, 'images', 'potion.png'),
+                self.imageFile('potion.png'),
                 x + 17,
                 potHeight,
                 potSize,
                 potSize,
                 preserveAspectRatio=True,
                 mask=[255, 255, 255, 255, 255, 255])
-            width += potSize
 
         self.canvas.setFont(self.fontNameBold, 12)
         self.canvas.drawCentredString(x + 8, costHeight, cost)
         self.canvas.setFillColorRGB(0, 0, 0)
-        return width
+        return self.costWidth(card)
 
     def drawSetIcon(self, setImage, x, y):
         # set image
         self.canvas.drawImage(
-            os.path.join(self.options.data_path, 'images', setImage),
+            self.imageFile(setImage),
             x,
             y,
             14,
             12,
             mask='auto')
 
+    def nameMetrics(self, name):
+        # The first letter of each word and the spaces are drawn at the full
+        # font size and the rest 2 points smaller, so the width of a name is
+        # fontSize * full + (fontSize - 2) * small for any size.
+        key = (self.fontNameRegular, name)
+        if key not in self.nameMetricsCache:
+            widths = self.glyphWidths.setdefault(self.fontNameRegular, {})
+            for char in set(name + ' ') - set(widths):
+                widths[char] = pdfmetrics.stringWidth(char, self.fontNameRegular, 1)
+            full = small = 0
+            for i, part in enumerate(name.split()):
+                if i != 0:
+                    full += widths[' ']
+                full += widths[part[0]]
+                small += sum(widths[char] for char in part[1:])
+            self.nameMetricsCache[key] = full, small
+        return self.nameMetricsCache[key]
+
     def nameWidth(self, name, fontSize):
-        w = 0
-        name_parts = name.split()
-        for i, part in enumerate(name_parts):
-            if i != 0:
-                w += pdfmetrics.stringWidth(' ', self.fontNameRegular,
-                                            fontSize)
-            w += pdfmetrics.stringWidth(part[0], self.fontNameRegular,
-                                        fontSize)
-            w += pdfmetrics.stringWidth(part[1:], self.fontNameRegular,
-                                        fontSize - 2)
-        return w
+        full, small = self.nameMetrics(name)
+        return fontSize * full + (fontSize - 2) * small
+
+    def tabSizes(self, fontSize):
+        # the sizes a tab name is tried at, from fontSize down in steps of
+        # .01 until it is 8 or less
+        if fontSize not in self.tabNameSizes:
+            sizes = [fontSize]
+            while sizes[-1] > 8:
+                sizes.append(sizes[-1] - .01)
+            self.tabNameSizes[fontSize] = sizes
+        return self.tabNameSizes[fontSize]
+
+    def fitTabName(self, name, fontSize, textWidth):
+        # The largest of the sizes tried the name fits at, or the smallest
+        # if it fits at none.  A name gets wider with its size, so rather
+        # than trying them one after the other the sizes are bisected.
+        key = (self.fontNameRegular, name, fontSize, textWidth)
+        if key not in self.tabNameFits:
+            sizes = self.tabSizes(fontSize)
+            lo, hi = 0, len(sizes) - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.nameWidth(name, sizes[mid]) > textWidth:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            self.tabNameFits[key] = sizes[lo], self.nameWidth(name, sizes[lo])
+        return self.tabNameFits[key]
+
+    def tabHasCost(self, card):
+        return not card.isExpansion() and not card.isBlank(
+        ) and not card.isLandmark() and not card.isType('Trash')
+
+    def tabTextInsets(self, card):
+        # the space on the tab left of the name, taken by the cost, and right
+        # of it, taken by the set icon
+        if self.tabHasCost(card):
+            if 'tab' in self.options.cost:
+                textInset = 4 + self.costWidth(card)
+            else:
+                textInset = 6
+        else:
+            textInset = 13
+
+        # always need to offset from right edge, to make sure it stays on
+        # banner
+        textInsetRight = 6
+        if self.options.use_text_set_icon:
+            textInsetRight = 15
+        elif card.setImage() and 'tab' in self.options.set_icon:
+            textInsetRight = 20
+        return textInset, textInsetRight
+
+    def fitCardTabName(self, card):
+        # the size the name of the card is drawn at on its tab, the width it
+        # takes and the width there is for it
+        textInset, textInsetRight = self.tabTextInsets(card)
+        # allow for 3 pt border on each side
+        textWidth = self.options.labelWidth - 6
+        textWidth -= textInset
+        textWidth -= textInsetRight
+        fontSize, width = self.fitTabName(card.name.upper(), 12, textWidth)
+        return fontSize, width, textWidth
+
+    def layoutCardTabName(self, card):
+        # the size the name of the card is drawn at on its tab and the lines
+        # it is drawn on: one if it fits, otherwise split after a slash or
+        # the first word
+        fontSize, width, textWidth = self.fitCardTabName(card)
+        key = (self.fontNameRegular, card.name, textWidth)
+        if key not in self.tabNameLayouts:
+            name = card.name.upper()
+            if width > textWidth:
+                name_lines = name.partition(' / ')
+                if name_lines[1]:
+                    name_lines = (name_lines[0] + ' /', name_lines[2])
+                else:
+                    name_lines = name.split(None, 1)
+            else:
+                name_lines = [name]
+            self.tabNameLayouts[key] = fontSize, name_lines
+        return self.tabNameLayouts[key]
+
+    def prefitTabNames(self, cards):
+        # All the tab names are laid out before drawing starts: the names
+        # are measured first, then fitted and split from those widths.
+        for card in cards:
+            self.nameMetrics(card.name.upper())
+        for card in cards:
+            self.layoutCardTabName(card)
 
     def drawTab(self, card, rightSide, wrapper="no"):
         # draw tab flap
@@ -441,8 +724,6 @@ class DividerDrawer(object):
         if wrapper == "back":
             self.canvas.rotate(180)
 
-        # allow for 3 pt border on each side
-        textWidth = self.options.labelWidth - 6
         textHeight = 7
         if self.options.no_tab_artwork:
             textHeight = 4
@@ -450,10 +731,10 @@ class DividerDrawer(object):
             card.getType().getTabTextHeightOffset()
 
         # draw banner
-        img = card.getType().getNoCoinTabImageFile()
+        img = card.tabImage()
         if not self.options.no_tab_artwork and img:
             self.canvas.drawImage(
-                os.path.join(self.options.data_path, 'images', img),
+                self.imageFile(img),
                 1,
                 0,
                 self.options.labelWidth - 2,
@@ -462,23 +743,13 @@ class DividerDrawer(object):
                 anchor='n',
                 mask='auto')
 
+        textInset, textInsetRight = self.tabTextInsets(card)
+
         # draw cost
-        if not card.isExpansion() and not card.isBlank(
-        ) and not card.isLandmark() and not card.isType('Trash'):
-            if 'tab' in self.options.cost:
-                textInset = 4
-                textInset += self.drawCost(
-                    card, textInset, textHeight,
-                    card.getType().getTabCostHeightOffset())
-            else:
-                textInset = 6
-        else:
-            textInset = 13
+        if self.tabHasCost(card) and 'tab' in self.options.cost:
+            self.drawCost(card, 4, textHeight, card.getType().getTabCostHeightOffset())
 
         # draw set image
-        # always need to offset from right edge, to make sure it stays on
-        # banner
-        textInsetRight = 6
         if self.options.use_text_set_icon:
             setImageHeight = card.getType().getTabTextHeightOffset()
             setText = card.setTextIcon()
@@ -488,7 +759,6 @@ class DividerDrawer(object):
 
             self.canvas.drawCentredString(self.options.labelWidth - 10,
                                           textHeight + 2, setText)
-            textInsetRight = 15
         else:
             setImage = card.setImage()
             if setImage and 'tab' in self.options.set_icon:
@@ -497,35 +767,13 @@ class DividerDrawer(object):
                 self.drawSetIcon(setImage, self.options.labelWidth - 20,
                                  setImageHeight)
 
-                textInsetRight = 20
-
         # draw name
-        fontSize = 12
         name = card.name.upper()
-
-        textWidth -= textInset
-        textWidth -= textInsetRight
-
-        width = self.nameWidth(name, fontSize)
-        while width > textWidth and fontSize > 8:
-            fontSize -= .01
-            # print 'decreasing font size for tab of',name,'now',fontSize
-            width = self.nameWidth(name, fontSize)
-        tooLong = width > textWidth
-        if tooLong:
-            name_lines = name.partition(' / ')
-            if name_lines[1]:
-                name_lines = (name_lines[0] + ' /', name_lines[2])
-            else:
-                name_lines = name.split(None, 1)
-        else:
-            name_lines = [name]
-        # if tooLong:
-        #    print name
+        fontSize, name_lines = self.layoutCardTabName(card)
 
         for linenum, line in enumerate(name_lines):
             h = textHeight
-            if tooLong and len(name_lines) > 1:
+            if len(name_lines) > 1:
                 if linenum == 0:
                     h += h / 2
                 else:
@@ -608,10 +856,101 @@ class DividerDrawer(object):
 
         self.canvas.restoreState()
 
+    def textTopHeight(self, card, wrapper):
+        # the heights above the text of a divider taken by the thumb notch
+        # and by the icons drawn at the top of the body
+        notchHeight = 0
+        if wrapper == "front" or wrapper == "back":
+            if self.options.notch_width1 > 0:
+                notchHeight = self.options.notch_height
+        hasIcons = self.options.count or not card.isExpansion() and (
+            'body-top' in self.options.cost or
+            'body-top' in self.options.set_icon and card.setImage())
+        return notchHeight, 15 if hasIcons else 0
+
+    def textDescriptions(self, card, divider_text):
+        # the paragraphs to be printed on the divider, or None
+        if divider_text == "rules":
+            # Add the extra rules text to the divider, if there is any
+            return (card.extra, ) if card.extra else None
+        elif divider_text == "card":
+            # Add the card text to the divider
+            return re.split("\n", card.description)
+        # blank, or don't know what was asked, so don't print anything
+        return None
+
+    def textBox(self, availableHeight):
+        return (self.options.dividerWidth - 2 * self.textHorizontalMargin,
+                availableHeight - 2 * self.textVerticalMargin)
+
+    def fitText(self, card, descriptions, availableHeight):
+        # the paragraphs at the largest size at which they fit, and the
+        # space to leave between them
+        s = getSampleStyleSheet()['BodyText']
+        s.fontName = "Times-Roman"
+        s.alignment = TA_JUSTIFY
+
+        textBoxWidth, textBoxHeight = self.textBox(availableHeight)
+        spacerHeight = 0.2 * cm
+        minSpacerHeight = 0.05 * cm
+
+        # start from the sizes that fitted last time this text was drawn
+        fitKey = (tuple(descriptions), textBoxWidth, textBoxHeight)
+        fit = self.textFits.get(fitKey)
+        if fit:
+            s.fontSize, s.leading, spacerHeight = fit
+
+        while True:
+            paragraphs = []
+            # this accounts for the spacers we insert between paragraphs
+            h = (len(descriptions) - 1) * spacerHeight
+            for d in descriptions:
+                dmod = self.add_inline_images(card.textTemplate(d), s.fontSize)
+                p = Paragraph(dmod, s)
+                h += p.wrap(textBoxWidth, textBoxHeight)[1]
+                paragraphs.append(p)
+
+            if fit or h <= textBoxHeight or s.fontSize <= 1 or s.leading <= 1:
+                break
+            else:
+                s.fontSize -= 1
+                s.leading -= 1
+                spacerHeight = max(spacerHeight - 1, minSpacerHeight)
+        self.textFits[fitKey] = s.fontSize, s.leading, spacerHeight
+        return paragraphs, spacerHeight
+
+    def prefitText(self, card, divider_text="card", wrapper="no"):
+        # works out the text sizes drawText will use, without drawing, and
+        # returns the font size of the text, if there is any
+        descriptions = self.textDescriptions(card, divider_text)
+        if descriptions is None:
+            return None
+        totalHeight = self.options.dividerHeight - self.options.labelHeight
+        availableHeight = totalHeight - sum(self.textTopHeight(card, wrapper))
+        # sizes already found are not worked out again
+        fitKey = (tuple(descriptions), ) + self.textBox(availableHeight)
+        if fitKey not in self.textFits:
+            self.fitText(card, descriptions, availableHeight)
+        return self.textFits[fitKey][0]
+
+    def textSides(self):
+        # the text and wrapper side of each text drawn for a divider
+        if self.options.tabs_only:
+            return []
+        if self.options.wrapper:
+            return [(self.options.text_front, "front"), (self.options.text_back, "back")]
+        sides = [(self.options.text_front, "no")]
+        if self.hasBacks() and self.options.text_back != self.options.text_front:
+            sides.append((self.options.text_back, "no"))
+        return sides
+
+    def prefitCard(self, card):
+        for divider_text, wrapper in self.textSides():
+            self.prefitText(card, divider_text, wrapper)
+
     def drawText(self, card, divider_text="card", wrapper="no"):
 
         self.canvas.saveState()
-        usedHeight = 0
         totalHeight = self.options.dividerHeight - self.options.labelHeight
 
         # Figure out if any translation needs to be done
@@ -624,14 +963,10 @@ class DividerDrawer(object):
             self.canvas.translate(0, self.options.dividerHeight +
                                   card.getStackHeight(self.options.thickness))
 
-        if wrapper == "front" or wrapper == "back":
-            if self.options.notch_width1 > 0:
-                usedHeight += self.options.notch_height
+        usedHeight, iconHeight = self.textTopHeight(card, wrapper)
 
-        drewTopIcon = False
         if 'body-top' in self.options.cost and not card.isExpansion():
             self.drawCost(card, cm / 4.0, totalHeight - usedHeight - 0.5 * cm)
-            drewTopIcon = True
 
         Image_x = self.options.dividerWidth - 16
         if 'body-top' in self.options.set_icon and not card.isExpansion():
@@ -640,66 +975,25 @@ class DividerDrawer(object):
                 self.drawSetIcon(setImage, Image_x,
                                  totalHeight - usedHeight - 0.5 * cm - 3)
                 Image_x -= 16
-                drewTopIcon = True
 
         if self.options.count:
             self.drawCardCount(card, Image_x,
                                totalHeight - usedHeight - 0.5 * cm)
-            drewTopIcon = True
 
-        if drewTopIcon:
-            usedHeight += 15
+        usedHeight += iconHeight
 
         # Figure out what text is to be printed on this divider
-        if divider_text == "blank":
-            # blank divider, no need to go on
-            return
-        elif divider_text == "rules":
-            # Add the extra rules text to the divider
-            if card.extra:
-                descriptions = (card.extra, )
-            else:
-                # Asked for rules and they don't exist, so don't print anything
-                return
-        elif divider_text == "card":
-            # Add the card text to the divider
-            descriptions = re.split("\n", card.description)
-        else:
-            # Don't know what was asked, so don't print anything
+        descriptions = self.textDescriptions(card, divider_text)
+        if descriptions is None:
+            self.canvas.restoreState()
             return
 
-        s = getSampleStyleSheet()['BodyText']
-        s.fontName = "Times-Roman"
-        s.alignment = TA_JUSTIFY
+        paragraphs, spacerHeight = self.fitText(card, descriptions, totalHeight - usedHeight)
 
-        textHorizontalMargin = .5 * cm
-        textVerticalMargin = .3 * cm
-        textBoxWidth = self.options.dividerWidth - 2 * textHorizontalMargin
-        textBoxHeight = totalHeight - usedHeight - 2 * textVerticalMargin
-        spacerHeight = 0.2 * cm
-        minSpacerHeight = 0.05 * cm
-
-        while True:
-            paragraphs = []
-            # this accounts for the spacers we insert between paragraphs
-            h = (len(descriptions) - 1) * spacerHeight
-            for d in descriptions:
-                dmod = self.add_inline_images(d, s.fontSize)
-                p = Paragraph(dmod, s)
-                h += p.wrap(textBoxWidth, textBoxHeight)[1]
-                paragraphs.append(p)
-
-            if h <= textBoxHeight or s.fontSize <= 1 or s.leading <= 1:
-                break
-            else:
-                s.fontSize -= 1
-                s.leading -= 1
-                spacerHeight = max(spacerHeight - 1, minSpacerHeight)
-
-        h = totalHeight - usedHeight - textVerticalMargin
+        h = totalHeight - usedHeight - self.textVerticalMargin
         for p in paragraphs:
             h -= p.height
-            p.drawOn(self.canvas, textHorizontalMargin, h)
+            p.drawOn(self.canvas, self.textHorizontalMargin, h)
             h -= spacerHeight
 
         self.canvas.restoreState()
@@ -710,7 +1004,8 @@ class DividerDrawer(object):
                     y,
                     isBack=False,
                     divider_text="card",
-                    divider_text2="rules"):
+                    divider_text2="rules",
+                    yPos=None):
         # figure out whether the tab should go on the right side or not
         if self.options.tab_side == "right":
             rightSide = isBack
@@ -730,8 +1025,9 @@ class DividerDrawer(object):
         if isBack:
             self.canvas.translate(self.options.back_offset,
                                   self.options.back_offset_height)
-        self.canvas.translate(x * self.options.dividerWidthReserved,
-                              y * self.options.dividerHeightReserved)
+        if yPos is None:
+            yPos = y * self.options.dividerHeightReserved
+        self.canvas.translate(x * self.options.dividerWidthReserved, yPos)
 
         # actual drawing
         if not self.options.tabs_only:
@@ -743,14 +1039,67 @@ class DividerDrawer(object):
             wrap = "no"
         self.drawTab(card, rightSide, wrapper=wrap)
         if not self.options.tabs_only:
-            self.drawText(card, divider_text, wrapper=wrap)
+            if self.textForms is not None:
+                self.drawTextForm(card, divider_text)
+            else:
+                self.drawText(card, divider_text, wrapper=wrap)
             if self.options.wrapper:
                 self.drawTab(card, rightSide, wrapper="back")
                 self.drawText(card, divider_text2, wrapper="back")
 
-    def drawSetNames(self, pageCards):
+    # about how many bytes more a text takes as a form than drawn in place,
+    # and how many a line of icons takes, against about one per character
+    # of text drawn
+    textFormCost = 800
+    textIconsCost = 100
+
+    def textKey(self, card, divider_text):
+        # what the text of a divider looks like, so that dividers and sides
+        # showing the same text can share it: the paragraphs, and the card
+        # if icons of its own are drawn above them
+        descriptions = self.textDescriptions(card, divider_text)
+        hasIcons = self.textTopHeight(card, "no")[1]
+        return (tuple(descriptions) if descriptions is not None else None,
+                id(card) if hasIcons else None)
+
+    def planTextForms(self, cards):
+        # the names of the forms of the texts drawn often enough for one to
+        # take less space than drawing them each time, by textKey
+        texts = [self.options.text_front]
+        if self.hasBacks():
+            texts.append(self.options.text_back)
+        keys = [self.textKey(card, divider_text) for card in cards for divider_text in texts]
+        uses = collections.Counter(keys)
+        forms = {}
+        for key in keys:
+            descriptions, icons = key
+            size = sum(len(d) for d in descriptions or ()) + (self.textIconsCost if icons else 0)
+            if key not in forms and (uses[key] - 1) * size > self.textFormCost:
+                forms[key] = 'text{}'.format(len(forms))
+        return forms
+
+    def drawTextForm(self, card, divider_text):
+        # text shown often is laid out once as a form, which the other
+        # dividers and sides showing it then show again; a blank text with
+        # no icons has nothing to draw
+        key = self.textKey(card, divider_text)
+        if key == (None, None):
+            return
+        name = self.textForms.get(key)
+        if name is None:
+            self.drawText(card, divider_text)
+            return
+        if not self.canvas.hasForm(name):
+            self.canvas.beginForm(name, 0, 0, self.options.dividerWidth, self.options.dividerHeight)
+            self.drawText(card, divider_text)
+            self.canvas.endForm()
+        self.canvas.doForm(name)
+
+    def drawSetNames(self, pageCards, bottomMargin=None):
         # print sets for this page
         self.canvas.saveState()
+        if bottomMargin is None:
+            bottomMargin = self.options.verticalMargin
 
         try:
             # calculate the text height, font size, and orientation
@@ -765,7 +1114,7 @@ class DividerDrawer(object):
 
             layouts = [{'rotation': 0,
                         'minMarginHeight': self.options.minVerticalMargin,
-                        'totalMarginHeight': self.options.verticalMargin,
+                        'totalMarginHeight': bottomMargin,
                         'width': self.options.paperwidth},
                        {'rotation': 90,
                         'minMarginHeight': self.options.minHorizontalMargin,
@@ -811,62 +1160,149 @@ class DividerDrawer(object):
         finally:
             self.canvas.restoreState()
 
-    def drawDividers(self, cards):
-        # split into pages
-        cards = split(cards, self.options.numDividersVertical *
-                      self.options.numDividersHorizontal)
+    def packWrappers(self, cards):
+        return packWrappers(cards, self.options)
+
+    def paginate(self, cards):
+        # split into pages, with the height of each card on the page when
+        # wrappers are packed
+        if self.options.wrapper and not self.options.tabs_only:
+            return self.packWrappers(cards)
+        return [(pageCards, None) for pageCards in split(
+            cards, self.options.numDividersVertical * self.options.numDividersHorizontal)]
 
+    def startOdd(self):
         # Starting with tabs on the left or the right?
         if self.options.tab_side in ["right-alternate", "right"]:
-            self.odd = True
+            return True
         else:
             # left-alternate, left, full
-            self.odd = False
-
-        for pageNum, pageCards in enumerate(cards):
+            return False
+
+    def drawFronts(self, pageCards, positions):
+        if not self.options.no_page_footer and (
+                not self.options.tabs_only and
+                self.options.order != "global"):
+            if positions:
+                self.drawSetNames(pageCards, self.options.verticalMargin + min(positions))
+            else:
+                self.drawSetNames(pageCards)
+        for i, card in enumerate(pageCards):
+            # print card
+            x = i % self.options.numDividersHorizontal
+            y = i / self.options.numDividersHorizontal
+            self.canvas.saveState()
+            self.drawDivider(card,
+                             x,
+                             self.options.numDividersVertical - 1 - y,
+                             isBack=False,
+                             divider_text=self.options.text_front,
+                             divider_text2=self.options.text_back,
+                             yPos=positions[i] if positions else None)
+            self.canvas.restoreState()
+            self.odd = not self.odd
+            self.dividerDone()
+
+    def drawBacks(self, pageCards):
+        if not self.options.no_page_footer and self.options.order != "global":
+            self.drawSetNames(pageCards)
+        for i, card in enumerate(pageCards):
+            # print card
+            x = (self.options.numDividersHorizontal - 1 - i
+                 ) % self.options.numDividersHorizontal
+            y = i / self.options.numDividersHorizontal
+            self.canvas.saveState()
+            self.drawDivider(card,
+                             x,
+                             self.options.numDividersVertical - 1 - y,
+                             isBack=True,
+                             divider_text=self.options.text_back)
+            self.canvas.restoreState()
+            self.odd = not self.odd
+            self.dividerDone()
+
+    def checkCancelled(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise RenderCancelled()
+
+    def hasBacks(self):
+        return not (self.options.tabs_only or self.options.text_back == "none" or self.options.wrapper)
+
+    def countPages(self, pages):
+        # the number of dividers and pages that are going to be drawn
+        if self.options.num_pages > 0:
+            pages = pages[:self.options.num_pages]
+        numDividers = sum(len(pageCards) for pageCards, positions in pages)
+        numPages = len(pages)
+        if self.hasBacks():
+            numDividers *= 2
+            numPages *= 2
+            if len(pages) == self.options.num_pages:
+                # the last page stops before its backs
+                numDividers -= len(pages[-1][0])
+                numPages -= 1
+        return numDividers, numPages
+
+    def startProgress(self, pages):
+        numDividers, numPages = self.countPages(pages)
+        self.progressCounts = {'divider': [0, numDividers], 'page': [0, numPages]}
+        self.progressStart = time.time()
+
+    def reportProgress(self, kind):
+        if self.progress is not None:
+            counts = self.progressCounts[kind]
+            counts[0] += 1
+            self.progress(kind, counts[0], counts[1], time.time() - self.progressStart)
+
+    def dividerDone(self):
+        self.reportProgress('divider')
+        self.checkCancelled()
+
+    def pageDone(self):
+        self.canvas.showPage()
+        self.reportProgress('page')
+
+    def drawDividers(self, cards, odd=None):
+        self.odd = self.startOdd() if odd is None else odd
+        self.prefitTabNames(cards)
+        pages = self.paginate(cards)
+        self.startProgress(pages)
+
+        for pageNum, (pageCards, positions) in enumerate(pages):
+            self.checkCancelled()
             # remember whether we start with odd or even divider for tab
             # location
             pageStartOdd = self.odd
-            if not self.options.no_page_footer and (
-                    not self.options.tabs_only and
-                    self.options.order != "global"):
-                self.drawSetNames(pageCards)
-            for i, card in enumerate(pageCards):
-                # print card
-                x = i % self.options.numDividersHorizontal
-                y = i / self.options.numDividersHorizontal
-                self.canvas.saveState()
-                self.drawDivider(card,
-                                 x,
-                                 self.options.numDividersVertical - 1 - y,
-                                 isBack=False,
-                                 divider_text=self.options.text_front,
-                                 divider_text2=self.options.text_back)
-                self.canvas.restoreState()
-                self.odd = not self.odd
-            self.canvas.showPage()
+            self.drawFronts(pageCards, positions)
+            self.pageDone()
             if pageNum + 1 == self.options.num_pages:
                 break
-            if self.options.tabs_only or self.options.text_back == "none" or self.options.wrapper:
+            if not self.hasBacks():
                 # Don't print the sheets with the back of the dividers
                 continue
-            if not self.options.no_page_footer and self.options.order != "global":
-                self.drawSetNames(pageCards)
             # start at same oddness
             self.odd = pageStartOdd
-            for i, card in enumerate(pageCards):
-                # print card
-                x = (self.options.numDividersHorizontal - 1 - i
-                     ) % self.options.numDividersHorizontal
-                y = i / self.options.numDividersHorizontal
-                self.canvas.saveState()
-                self.drawDivider(card,
-                                 x,
-                                 self.options.numDividersVertical - 1 - y,
-                                 isBack=True,
-                                 divider_text=self.options.text_back)
-                self.canvas.restoreState()
-                self.odd = not self.odd
-            self.canvas.showPage()
+            self.drawBacks(pageCards)
+            self.pageDone()
             if pageNum + 1 == self.options.num_pages:
                 break
+
+    def drawPreviewPage(self, cards, options, canvas, pageNum):
+        # draw the front of one page onto the given canvas
+        job = self.job(options, canvas)
+        pages = job.paginate(cards)
+        assert 0 <= pageNum < len(pages), 'There are only {} pages'.format(len(pages))
+        job.odd = job.startOdd()
+        for pageCards, positions in pages[:pageNum]:
+            if len(pageCards) % 2:
+                job.odd = not job.odd
+        job.drawFronts(*pages[pageNum])
+        return len(pages)
+
+    def drawPreviewDivider(self, card, options, canvas):
+        # draw a single divider at the bottom left of the page
+        job = self.job(options, canvas)
+        job.odd = job.startOdd()
+        job.drawDivider(card, 0, 0,
+                        divider_text=options.text_front,
+                        divider_text2=options.text_back)
@@ -0,0 +1,270 @@
+from PIL import Image
+
+from reportlab.lib import colors
+from reportlab.lib.boxstuff import aspectRatioFix
+from reportlab.pdfbase import pdfdoc
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfgen import textobject
+from reportlab.graphics import renderPM
+from reportlab.graphics import renderSVG
+from reportlab.graphics import shapes
+
+
+class PreviewTextObject(textobject.PDFTextObject):
+    # Paragraphs write their text through a text object; rather than
+    # collecting PDF operators, draw each run straight onto the bitmap and
+    # keep track of where the PDF text cursor would have ended up.
+
+    def __init__(self, canvas, x=0, y=0, direction=None):
+        self._wordSpace = 0
+        self._charSpace = 0
+        self._rise = 0
+        self._fillColor = canvas._fillColor
+        textobject.PDFTextObject.__init__(self, canvas, x, y, direction)
+
+    def setFillColor(self, aColor, alpha=None):
+        self._fillColor = colors.toColor(aColor)
+
+    def setFillColorRGB(self, r, g, b, alpha=None):
+        self._fillColor = colors.Color(r, g, b)
+
+    def setRise(self, rise):
+        self._rise = rise
+
+    def _textOut(self, text, TStar=0):
+        self._x += self._canvas.drawTextRun(self._x, self._y + self._rise, text,
+                                            self._fontname, self._fontsize,
+                                            self._fillColor, self._wordSpace,
+                                            self._charSpace)
+        if TStar:
+            self._y0 -= self._leading
+            self._x, self._y = self._x0, self._y0
+
+
+class PreviewCanvas(object):
+    # Just enough of the pdfgen canvas for DividerDrawer and Paragraph,
+    # drawn onto a bitmap with reportlab's renderPM.  origin moves the
+    # page so that only part of it needs to be rendered.  Neither renderPM
+    # nor Paragraph offer a public way to do this, so setup.py pins the
+    # reportlab versions whose internals this is known to work with.
+
+    bottomup = 1
+
+    def __init__(self, width, height, dpi=72, origin=(0, 0)):
+        self._pm = renderPM.PMCanvas(width, height, dpi=dpi)
+        self._setup(self._pm._baseCTM, origin)
+
+    def _setup(self, baseCTM, origin):
+        self._baseCTM = shapes.mmult(baseCTM, shapes.translate(*origin))
+        self._doc = pdfdoc.PDFDocument()
+        self._colorsUsed = {}
+        self._images = {}
+        self._pixels = {}
+        self._state = []
+        self._ctm = self._baseCTM
+        self._fontname = 'Helvetica'
+        self._fontsize = 12
+        self._leading = 14.4
+        self._fillColor = colors.black
+        self._strokeColor = colors.black
+        self._lineWidth = 1
+
+    def saveState(self):
+        self._state.append((self._ctm, self._fontname, self._fontsize, self._leading,
+                            self._fillColor, self._strokeColor, self._lineWidth))
+
+    def restoreState(self):
+        (self._ctm, self._fontname, self._fontsize, self._leading,
+         self._fillColor, self._strokeColor, self._lineWidth) = self._state.pop()
+
+    def resetTransforms(self):
+        self._ctm = self._baseCTM
+
+    def translate(self, dx, dy):
+        self._ctm = shapes.mmult(self._ctm, shapes.translate(dx, dy))
+
+    def scale(self, x, y):
+        self._ctm = shapes.mmult(self._ctm, shapes.scale(x, y))
+
+    def rotate(self, theta):
+        self._ctm = shapes.mmult(self._ctm, shapes.rotate(theta))
+
+    def setLineWidth(self, width):
+        self._lineWidth = width
+
+    def setStrokeColor(self, aColor, alpha=None):
+        self._strokeColor = colors.toColor(aColor)
+
+    def setStrokeGray(self, gray, alpha=None):
+        self._strokeColor = colors.Color(gray, gray, gray)
+
+    def setFillColor(self, aColor, alpha=None):
+        self._fillColor = colors.toColor(aColor)
+
+    def setFillColorRGB(self, r, g, b, alpha=None):
+        self._fillColor = colors.Color(r, g, b)
+
+    def setFont(self, psfontname, size, leading=None):
+        self._fontname = psfontname
+        self._fontsize = size
+        self._leading = size * 1.2 if leading is None else leading
+
+    def _prepare(self):
+        self._pm.ctm = self._ctm
+        self._pm.strokeColor = self._strokeColor
+        self._pm.strokeWidth = self._lineWidth
+        self._pm.fillColor = self._fillColor
+
+    def line(self, x1, y1, x2, y2):
+        self._prepare()
+        self._pm.line(x1, y1, x2, y2)
+
+    def lines(self, linelist):
+        for x1, y1, x2, y2 in linelist:
+            self.line(x1, y1, x2, y2)
+
+    def rect(self, x, y, width, height, stroke=1, fill=0):
+        self._prepare()
+        self._pm.rect(x, y, width, height, stroke=stroke, fill=fill)
+
+    def stringWidth(self, text, fontName=None, fontSize=None):
+        return pdfmetrics.stringWidth(text, fontName or self._fontname, fontSize or self._fontsize)
+
+    def drawTextRun(self, x, y, text, fontName, fontSize, fillColor, wordSpace=0, charSpace=0):
+        # draws text the way a PDF text object would, returning its advance
+        self._pm.ctm = self._ctm
+        self._pm.fillColor = fillColor
+        self._pm.setFont(fontName, fontSize)
+        return self._drawChars(x, y, text, fontName, fontSize, wordSpace, charSpace)
+
+    def _drawChars(self, x, y, text, fontName, fontSize, wordSpace, charSpace):
+        if not wordSpace and not charSpace:
+            self._drawRun(x, y, text)
+            return pdfmetrics.stringWidth(text, fontName, fontSize)
+        start = x
+        for char in text:
+            self._drawRun(x, y, char)
+            x += pdfmetrics.stringWidth(char, fontName, fontSize) + charSpace
+            if char == ' ':
+                x += wordSpace
+        return x - start
+
+    def _drawRun(self, x, y, text):
+        self._pm.drawString(x, y, text)
+
+    def drawString(self, x, y, text):
+        self.drawTextRun(x, y, text, self._fontname, self._fontsize, self._fillColor)
+
+    def drawCentredString(self, x, y, text):
+        width = pdfmetrics.stringWidth(text, self._fontname, self._fontsize)
+        self.drawString(x - width / 2.0, y, text)
+
+    def drawRightString(self, x, y, text):
+        width = pdfmetrics.stringWidth(text, self._fontname, self._fontsize)
+        self.drawString(x - width, y, text)
+
+    def beginText(self, x=0, y=0, direction=None):
+        return PreviewTextObject(self, x, y, direction)
+
+    def drawText(self, textobject):
+        # already drawn as it was written
+        pass
+
+    def openImage(self, image, mask):
+        # paragraphs hand over inline images as ImageReaders
+        image = getattr(image, 'fileName', image)
+        key = (image, str(mask))
+        if key not in self._images:
+            im = Image.open(image).convert('RGBA')
+            if mask and mask != 'auto':
+                # colour ranges to be left transparent
+                r0, r1, g0, g1, b0, b1 = mask
+                im.putalpha(Image.eval(im.convert('RGB').point(
+                    [0 if r0 <= v <= r1 else 255 for v in range(256)] +
+                    [0 if g0 <= v <= g1 else 255 for v in range(256)] +
+                    [0 if b0 <= v <= b1 else 255 for v in range(256)]).convert('L'),
+                    lambda v: 0 if v == 0 else 255))
+            self._images[key] = im
+        return self._images[key]
+
+    def getImage(self, image, mask):
+        key = (getattr(image, 'fileName', image), str(mask))
+        if key not in self._pixels:
+            im = self.openImage(image, mask)
+            self._pixels[key] = (im.tobytes(), im.size[0], im.size[1])
+        return self._pixels[key]
+
+    def drawImage(self, image, x, y, width=None, height=None, mask=None,
+                  preserveAspectRatio=False, anchor='c', anchorAtXY=False, showBoundary=False):
+        data, imWidth, imHeight = self.getImage(image, mask)
+        x, y, width, height, scaled = aspectRatioFix(preserveAspectRatio, anchor, x, y, width, height,
+                                                     imWidth, imHeight, anchorAtXY)
+        self._pm.ctm = self._ctm
+        self._pm._aapixbuf(x, y, width, height, data, imWidth, imHeight, 4)
+
+    def showPage(self):
+        pass
+
+    def save(self):
+        pass
+
+    def toPIL(self):
+        return self._pm.toPIL()
+
+
+class SVGPreviewCanvas(PreviewCanvas):
+    # The same, written as SVG.  renderSVG has no transformation matrix of
+    # its own to speak of, so everything is drawn in a group carrying the
+    # current one.
+
+    def __init__(self, width, height, origin=(0, 0)):
+        self._svg = renderSVG.SVGCanvas((width, height))
+        self._setup(shapes.nullTransform(), origin)
+
+    def _group(self, *transforms):
+        ctm = self._ctm
+        for transform in transforms:
+            ctm = shapes.mmult(ctm, transform)
+        return self._svg.startGroup({'transform': 'matrix(%s)' % self._svg.cfp_str(*ctm)})
+
+    def _prepare(self, stroke=1, fill=0):
+        self._svg.setStrokeColor(self._strokeColor if stroke else None)
+        self._svg.setFillColor(self._fillColor if fill else None)
+        self._svg.setLineWidth(self._lineWidth)
+
+    def line(self, x1, y1, x2, y2):
+        self._prepare()
+        group = self._group()
+        self._svg.line(x1, y1, x2, y2)
+        self._svg.endGroup(group)
+
+    def rect(self, x, y, width, height, stroke=1, fill=0):
+        self._prepare(stroke, fill)
+        group = self._group()
+        self._svg.rect(x, y, x + width, y + height)
+        self._svg.endGroup(group)
+
+    def drawTextRun(self, x, y, text, fontName, fontSize, fillColor, wordSpace=0, charSpace=0):
+        self._svg.setFillColor(fillColor)
+        self._svg.setFont(fontName, fontSize)
+        return self._drawChars(x, y, text, fontName, fontSize, wordSpace, charSpace)
+
+    def _drawRun(self, x, y, text):
+        # renderSVG rounds the position of text to whole points, so move
+        # the group there instead
+        group = self._group(shapes.translate(x, y))
+        self._svg.drawString(text, 0, 0)
+        self._svg.endGroup(group)
+
+    def drawImage(self, image, x, y, width=None, height=None, mask=None,
+                  preserveAspectRatio=False, anchor='c', anchorAtXY=False, showBoundary=False):
+        im = self.openImage(image, mask)
+        x, y, width, height, scaled = aspectRatioFix(preserveAspectRatio, anchor, x, y, width, height,
+                                                     im.size[0], im.size[1], anchorAtXY)
+        # SVG images are drawn top down
+        group = self._group(shapes.translate(x, y + height), shapes.scale(1, -1))
+        self._svg.drawImage(im, 0, 0, width, height)
+        self._svg.endGroup(group)
+
+    def saveSVG(self, fname):
+        self._svg.save(fname)
@@ -3,4 +3,7 @@ import os
 import sys
 
 if __name__ == '__main__':
-    domdiv.main(sys.argv[1:], os.path.dirname(__file__))
+    result = domdiv.main(sys.argv[1:], os.path.dirname(__file__))
+    # the modes that check something return an exit status, the others
+    # what they made
+    sys.exit(result if isinstance(result, int) else 0)
@@ -10,7 +10,9 @@ setup(
         ],
     },
     packages=find_packages(exclude=['tests']),
-    install_requires=["reportlab>=2.5",
+    # the previews draw with reportlab internals, checked against 3.5 (the
+    # last release for Python 2) by tests/output_tests.py
+    install_requires=["reportlab>=3.5,<3.6",
                       "Pillow>=2.1.0"],
     package_data={
         'domdiv': ['images/*.png', 'card_db/*/*.json']
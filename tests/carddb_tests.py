@@ -1,8 +1,25 @@
+# coding=utf-8
+import os
+import sys
+import json
+import shutil
+import tempfile
 import unittest
 from .. import domdiv
 from ..domdiv import cards as domdiv_cards
 
 
+class AsciiOutput(object):
+    # what print writes to when stdout is a pipe or a file: unicode is
+    # encoded as ASCII
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(str(data))
+
+
 class TestCardDB(unittest.TestCase):
 
     def test_cardread(self):
@@ -47,3 +64,198 @@ class TestCardDB(unittest.TestCase):
         cards = domdiv.read_write_card_data(options)
         self.assertTrue(cards, 'German cards did not read properly')
         self.assertIn("Fluch", [card.name for card in cards])
+
+    def test_language_mappings_kept_apart(self):
+        options = domdiv.parse_opts(['--language', 'de'])
+        options.data_path = '.'
+        de_cards = domdiv.read_write_card_data(options)
+        options = domdiv.parse_opts(['--language', 'it'])
+        options.data_path = '.'
+        it_cards = domdiv.read_write_card_data(options)
+        de_card = next(c for c in de_cards if c.cardset == u'Blütezeit')
+        self.assertEqual(de_card.language_mapping[u'Blütezeit'], 'prosperity')
+        self.assertEqual(de_card.setImage(), 'prosperity_set.png')
+        self.assertNotIn(u'Blütezeit', it_cards[0].language_mapping)
+
+    def test_all_languages(self):
+        options = domdiv.parse_opts(['--language', 'all'])
+        options.data_path = '.'
+        self.assertEqual(domdiv.get_languages(options), ['de', 'en_us', 'fr', 'it'])
+        options = domdiv.parse_opts(['--language', 'en_us, de'])
+        options.data_path = '.'
+        self.assertEqual(domdiv.get_languages(options), ['en_us', 'de'])
+
+    def test_compile(self):
+        images = set(os.listdir(os.path.join('.', 'images')))
+        cards, problems = domdiv.compile_language(os.path.join('.', 'card_db', 'en_us'), images)
+        self.assertEquals(len(cards), 386)
+        self.assertEquals(problems, [u'no set image for set "promo" (3 cards, e.g. "Sauna")'])
+        for c in cards:
+            self.assertTrue(c.compiled)
+            self.assertEquals(c.setImage(), domdiv_cards.Card.getSetImage(c.cardset, c.name, c.language_mapping))
+        witch = next(c for c in cards if c.name == 'Witch')
+        self.assertEquals(witch.textTemplate(witch.description), witch.markup[witch.description])
+        # survives a round trip through the compiled database
+        encoded = json.dumps(witch, cls=domdiv_cards.Card.CompiledCardJSONEncoder)
+        decoded = domdiv_cards.Card.decode_json(json.loads(encoded))
+        self.assertTrue(decoded.compiled)
+        self.assertEquals(decoded.markup, witch.markup)
+        self.assertNotIn('markup', json.loads(json.dumps(witch, cls=domdiv_cards.Card.CardJSONEncoder)))
+
+    def test_compile_db_status(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.symlink(os.path.abspath('images'), os.path.join(tmpdir, 'images'))
+            for language, cards in [('good', [{'name': 'Copper', 'cardset': 'base', 'cost': '0',
+                                               'types': ['Treasure'], 'card_id': 'copper'}]),
+                                    ('empty', [])]:
+                os.makedirs(os.path.join(tmpdir, 'card_db', language))
+                with open(os.path.join(tmpdir, 'card_db', language, 'cards.json'), 'w') as f:
+                    json.dump(cards, f)
+                with open(os.path.join(tmpdir, 'card_db', language, 'mapping.json'), 'w') as f:
+                    json.dump({}, f)
+            self.assertEquals(domdiv.main(['--compile_db', '--language', 'good'], tmpdir), 0)
+            data_dir = os.path.join(tmpdir, 'card_db', 'good')
+            self.assertEquals([c.name for c in domdiv.read_compiled_card_data(data_dir)], ['Copper'])
+            # compiled with tables the code no longer has
+            domdiv_cards.promoImages['test'] = 'test_set.png'
+            try:
+                self.assertEquals(domdiv.read_compiled_card_data(data_dir), None)
+            finally:
+                del domdiv_cards.promoImages['test']
+            # reported rather than failing on the missing cards
+            self.assertEquals(domdiv.main(['--compile_db', '--language', 'empty', '--sqlite_db',
+                                           os.path.join(tmpdir, 'cards.sqlite')], tmpdir), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sqlite_db(self):
+        from ..domdiv import carddb
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = os.path.join(tmpdir, 'cards.sqlite')
+            conn = carddb.connect(db)
+            names = {}
+            for language in ['en_us', 'de']:
+                options = domdiv.parse_opts(['--language', language])
+                options.data_path = '.'
+                cards = domdiv.read_write_card_data(options)
+                carddb.store_language(conn, language, cards, cards[0].language_mapping)
+                names[language] = [c.name for c in cards]
+            self.assertEquals([c.name for c in carddb.query_cards(conn, 'de', cardset='Dominion',
+                                                                  cardtype='Attack', cost=4)],
+                              [u'B\xfcrokrat', u'Miliz', u'Dieb'])
+            self.assertIn(u'Witch', [c.name for c in carddb.query_cards(conn, 'en_us', text='curse')])
+            self.assertEquals(carddb.read_language(conn, 'fr'), (None, None))
+            conn.close()
+
+            options = domdiv.parse_opts(['--sqlite_db', db, '--language', 'de'])
+            options.data_path = '.'
+            cards = domdiv.read_write_card_data(options)
+            self.assertEquals([c.name for c in cards], names['de'])
+            self.assertEquals(cards[0].language_mapping['Dominion'], 'dominion')
+
+            # a mistyped database is an error rather than an empty one
+            options = domdiv.parse_opts(['--sqlite_db', db + '.typo', '--language', 'de'])
+            options.data_path = '.'
+            self.assertRaises(IOError, domdiv.read_write_card_data, options)
+            self.assertFalse(os.path.exists(db + '.typo'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_card_ids(self):
+        options = domdiv.parse_opts([])
+        options.data_path = '.'
+        cards = domdiv.read_write_card_data(options)
+        ids = [c.card_id for c in cards]
+        self.assertNotIn(None, ids)
+        # a card in more than one set is the same card
+        self.assertEquals(len(set(ids)), len(set(c.name for c in cards)))
+        for language in ['de', 'fr', 'it']:
+            options = domdiv.parse_opts(['--language', language])
+            options.data_path = '.'
+            self.assertEquals([c.name for c in domdiv.read_write_card_data(options) if not c.card_id], [])
+
+        index = domdiv.card_index('.')
+        self.assertEquals(index.cardId(u'Vision', 'de'), 'scrying_pool')
+        self.assertEquals(index.cardId(u'Scrying Pool', 'de'), 'scrying_pool')
+        self.assertEquals(index.cardName('scrying_pool', 'de'), u'Vision')
+        self.assertEquals(index.cardName('scrying_pool', 'en_us'), u'Scrying Pool')
+        self.assertIsNone(index.cardId(u'No Such Card', 'de'))
+
+        # promo set images are found by id, whatever the card is called
+        options = domdiv.parse_opts(['--language', 'fr'])
+        options.data_path = '.'
+        cards = domdiv.read_write_card_data(options)
+        self.assertEquals(next(c for c in cards if c.card_id == 'black_market').setImage(),
+                          'black_market_set.png')
+
+    def test_cardlist_any_language(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cardlist = os.path.join(tmpdir, 'cardlist.txt')
+            with open(cardlist, 'w') as f:
+                f.write('Scrying Pool\nMiliz\nVillage\nCellar\nChapel\nNonesuch\n')
+            options = domdiv.parse_opts(['--language', 'de', '--cardlist', cardlist])
+            options.data_path = '.'
+            cards = domdiv.read_write_card_data(options)
+            self.assertEquals(sorted(c.name for c in domdiv.filter_sort_cards(cards, options)),
+                              [u'Dorf', u'Kapelle', u'Keller', u'Miliz', u'Vision'])
+            selected, unknown = domdiv.select_cards(cards, [u'Village', u'Nonesuch'], options)
+            self.assertEquals([c.name for c in selected], [u'Dorf'])
+            self.assertEquals(unknown, [u'Nonesuch'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_warnings_on_ascii_stdout(self):
+        card = domdiv_cards.Card(u'D\xe9l\xe9gu\xe9', u'\xc9dition', ('Action',), '4')
+        options = domdiv.parse_opts([])
+        stdout = sys.stdout
+        sys.stdout = output = AsciiOutput()
+        try:
+            self.assertIsNone(card.setImage())
+            self.assertIsNone(card.setTextIcon())
+            domdiv.bind_assets([card], options)
+        finally:
+            sys.stdout = stdout
+        self.assertIn('"\xc3\x89dition"', ''.join(output.written))
+
+    def test_inline_image_template(self):
+        template = domdiv_cards.inlineImageTemplate(u'+2 Coins, 50% <VP>')
+        self.assertIn("%(coin_small_2.png)s", template)
+        self.assertIn("%(victory_emblem.png)s", template)
+        text = template % {'coin_small_2.png': 'images/coin_small_2.png',
+                           'victory_emblem.png': 'images/victory_emblem.png', 'width': 12, 'vpwidth': 15}
+        self.assertIn("50%", text)
+        self.assertIn("height='100%'", text)
+
+    def test_cost_value(self):
+        for cost, value in [('5', 5), ('8*', 8), ('3+', 3), ('', None), ('*', None)]:
+            card = domdiv_cards.Card('Test', 'dominion', ('Action',), cost)
+            self.assertEquals(card.getCostValue(), value)
+
+    def test_assets_bound(self):
+        options = domdiv.parse_opts(['--expansion_dividers'])
+        options.data_path = '.'
+        cards = domdiv.filter_sort_cards(domdiv.read_write_card_data(options), options)
+        for c in cards:
+            self.assertTrue(c.bound)
+            self.assertEquals(c.setImage(), domdiv_cards.Card.getSetImage(c.cardset, c.name, c.language_mapping))
+            self.assertEquals(c.tabImage(), c.getType().getNoCoinTabImageFile())
+        expansion = next(c for c in cards if c.isExpansion())
+        self.assertEquals(expansion.tabImage(), 'expansion_nc.png')
+        # not part of the card data
+        self.assertNotIn('tab_image', json.loads(json.dumps(expansion, cls=domdiv_cards.Card.CardJSONEncoder)))
+
+    def test_filter_leaves_cards_untouched(self):
+        options = domdiv.parse_opts(['--special_card_groups', '--exclude_events', '--exclude_prizes'])
+        options.data_path = '.'
+        cards = domdiv.read_write_card_data(options)
+        before = [(c.name, c.count) for c in cards]
+        first = domdiv.filter_sort_cards(cards, options)
+        self.assertEquals([(c.name, c.count) for c in cards], before)
+        # a second job gets the same result from the same cards
+        second = domdiv.filter_sort_cards(cards, options)
+        self.assertEquals([(c.name, c.count) for c in first], [(c.name, c.count) for c in second])
+        self.assertGreater(max(c.getCardCount() for c in first if c.isType('Events')), 0)
+        self.assertEquals(max(c.getCardCount() for c in cards if c.isType('Events')), 0)
@@ -0,0 +1,104 @@
+# coding=utf-8
+import os
+import imp
+import codecs
+import unittest
+import cStringIO
+
+convert_csv = imp.load_source('convert_csv', os.path.join('tools', 'convert_csv.py'))
+
+CARDS = u'''[
+ {
+  "card_id": "cellar",
+  "potcost": 0,
+  "description": "+1 Aktion",
+  "extra": "",
+  "cost": "2",
+  "cardset": "Dominion",
+  "types": [
+   "Action"
+  ],
+  "name": "Keller"
+ },
+ {
+  "potcost": 0,
+  "description": "Entsorge bis zu vier Karten.",
+  "extra": "",
+  "cost": "2",
+  "cardset": "Dominion",
+  "types": [
+   "Action"
+  ],
+  "name": "Kapelle"
+ }
+]
+'''
+
+CONFIG = {'language': 'de',
+          'columns': {'name': 'Kartenname', 'cost': 'Kosten', 'cardset': 'Edition',
+                      'description': 'Kartentext', 'extra': 'Extra', 'types': 'Typ'},
+          'types': {u'Aktion': 'Action', u'Angriff': 'Attack'},
+          'piles': {u'Ritter': u'Ritter'}}
+
+
+def csvfile(*rows):
+    lines = [u'Kartenname,Kosten,Edition,Kartentext,Extra,Typ'] + list(rows)
+    return cStringIO.StringIO(u'\n'.join(lines).encode('utf-8') + '\n')
+
+
+class TestConvertCSV(unittest.TestCase):
+
+    def merge(self, *rows):
+        head, entries, tail = convert_csv.read_entries(CARDS)
+        merged, added, changed, removed = convert_csv.merge(
+            entries, convert_csv.read_rows(csvfile(*rows), CONFIG))
+        return convert_csv.merged_text(head, entries, merged, tail), added, changed, removed
+
+    def test_round_trip(self):
+        for language in ['de', 'en_us', 'fr', 'it']:
+            with codecs.open(os.path.join('card_db', language, 'cards.json'), 'r', 'utf-8') as cardfile:
+                text = cardfile.read()
+            head, entries, tail = convert_csv.read_entries(text)
+            self.assertEqual(convert_csv.merged_text(head, entries, entries, tail), text)
+        # written out the way it was written
+        for card, card_text, separator in convert_csv.read_entries(CARDS)[1]:
+            self.assertEqual(convert_csv.entry_text(card, card_text), card_text)
+
+    def test_unchanged(self):
+        self.assertEqual(self.merge(u'Keller,2,Dominion,+1 Aktion,,Aktion',
+                                    u'Kapelle,2,Dominion,Entsorge bis zu vier Karten.,,Aktion'),
+                         (CARDS, [], [], []))
+
+    def test_changed_entry(self):
+        text, added, changed, removed = self.merge(u'Keller,2,Dominion,+1 Aktion,Neu,Aktion',
+                                                   u'Kapelle,2,Dominion,Entsorge bis zu vier Karten.,,Aktion')
+        self.assertEqual((added, changed, removed), ([], [u'Keller'], []))
+        # only the changed card is written out again, as it was written
+        self.assertEqual(text, CARDS.replace(u'"extra": ""', u'"extra": "Neu"', 1))
+
+    def test_unknown_card(self):
+        # a card the database does not have is added at the end, and a card
+        # the spreadsheet does not have is removed
+        text, added, changed, removed = self.merge(u'Keller,2,Dominion,+1 Aktion,,Aktion',
+                                                   u'Miliz,4,Dominion,+2 Geld,,Aktion/Angriff')
+        self.assertEqual((added, changed, removed), ([u'Miliz'], [], [u'Kapelle']))
+        head, entries, tail = convert_csv.read_entries(text)
+        self.assertEqual([card['name'] for card, card_text, separator in entries], [u'Keller', u'Miliz'])
+        self.assertEqual(entries[1][0]['types'], [u'Action', u'Attack'])
+        self.assertEqual(entries[0][1], convert_csv.read_entries(CARDS)[1][0][1])
+
+        self.assertRaises(ValueError, self.merge, u'Keller,2,Dominion,+1 Aktion,,Aktion/Unbekannt')
+
+    def test_unconfigured_columns(self):
+        # fields the spreadsheet has no column for are left alone
+        cards = CARDS.replace(u'"potcost": 0,\n  "description": "+1 Aktion",\n  "extra": "",',
+                              u'"potcost": 1,\n  "description": "+1 Aktion",\n  "extra": "Alt",', 1)
+        self.assertIn(u'"potcost": 1', cards)
+        config = dict(CONFIG, columns={k: v for k, v in CONFIG['columns'].items() if k != 'extra'})
+        rows = cStringIO.StringIO(u'Kartenname,Kosten,Edition,Kartentext,Typ\n'
+                                  u'Keller,2,Dominion,+1 Aktion,Aktion\n'
+                                  u'Kapelle,2,Dominion,Entsorge bis zu vier Karten.,Aktion\n'.encode('utf-8'))
+        head, entries, tail = convert_csv.read_entries(cards)
+        merged, added, changed, removed = convert_csv.merge(entries, convert_csv.read_rows(rows, config))
+        self.assertEqual((added, changed, removed), ([], [], []))
+        self.assertEqual(convert_csv.merged_text(head, entries, merged, tail), cards)
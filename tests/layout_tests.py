@@ -32,3 +32,65 @@ class TestLayout(unittest.TestCase):
         self.assertEquals(options.dividerWidth, 9.4 * cm)
         self.assertEquals(options.labelHeight, 0.9 * cm)
         self.assertEquals(options.dividerHeight, 6.15 * cm + options.labelHeight)
+
+    def test_auto(self):
+        # a wide custom card fits four to a page held horizontally, but six held vertically
+        options = domdiv.parse_opts(['--orientation', 'auto', '--size', '12x5.9', '--papersize', 'LETTER'])
+        domdiv.calculate_layout(options)
+        self.assertEquals(options.orientation, 'vertical')
+        self.assertEquals(options.numDividersHorizontal * options.numDividersVertical, 6)
+        self.assertEquals(options.dividerWidth, 5.9 * cm)
+
+    def test_auto_keeps_horizontal(self):
+        options = domdiv.parse_opts(['--orientation', 'auto'])
+        domdiv.calculate_layout(options)
+        self.assertEquals(options.orientation, 'horizontal')
+        self.assertEquals(options.numDividersHorizontal, 2)
+        self.assertEquals(options.numDividersVertical, 3)
+
+    def test_wrapper_packing(self):
+        options = domdiv.parse_opts(['--wrapper', '--size', '9.1x5', '--papersize', 'LETTER'])
+        options.data_path = '.'
+        cards = domdiv.read_write_card_data(options)
+        kingdom = [c for c in cards if c.cardset == 'dominion' and c.getCardCount() == 10][:4]
+        curse = next(c for c in cards if c.name == 'Curse')
+        domdiv.calculate_layout(options, kingdom + [curse])
+        # the 30 card curse stack leaves room for only one row of wrappers...
+        self.assertEquals(options.numDividersVertical, 1)
+        dd = domdiv.DividerDrawer()
+        dd.options = options
+        pages = dd.packWrappers(kingdom + [curse])
+        # ...but two rows of 10 card stacks fit on a page
+        self.assertEquals([len(pageCards) for pageCards, positions in pages], [4, 1])
+
+    def test_wrapper_packing_margins(self):
+        # 0.5cm left and right, 3cm top and bottom
+        options = domdiv.parse_opts(['--wrapper', '--size', '9.1x5', '--papersize', 'LETTER',
+                                     '--minmargin', '0.5x3'])
+        options.data_path = '.'
+        cards = [c for c in domdiv.read_write_card_data(options) if c.cardset == 'dominion'][:12]
+        domdiv.calculate_layout(options, cards)
+        self.assertEquals(options.minTopBottomMargin, 3 * cm)
+        dd = domdiv.DividerDrawer()
+        dd.options = options
+        baseHeight = options.dividerHeightReserved - 2 * max(c.getStackHeight(options.thickness) for c in cards)
+        for pageCards, positions in dd.packWrappers(cards):
+            firstRow = pageCards[:options.numDividersHorizontal]
+            rowHeight = baseHeight + 2 * max(c.getStackHeight(options.thickness) for c in firstRow)
+            # positions are above the bottom margin
+            self.assertLessEqual(options.verticalMargin + positions[0] + rowHeight,
+                                 options.paperheight - 3 * cm + 0.001)
+            self.assertGreaterEqual(options.verticalMargin + positions[-1], 3 * cm - 0.001)
+
+    def test_auto_wrapper_packing(self):
+        # held vertically more wrappers fit the tallest stack, but held
+        # horizontally the rows of smaller stacks pack into fewer pages
+        options = domdiv.parse_opts(['--wrapper', '--size', '9.1x5', '--orientation', 'auto'])
+        options.data_path = '.'
+        cards = domdiv.filter_sort_cards(domdiv.read_write_card_data(options), options)
+        domdiv.calculate_layout(options, cards)
+        self.assertEquals(options.orientation, 'horizontal')
+        self.assertEquals(len(domdiv.packWrappers(cards, options)), 94)
+        vertical = domdiv.parse_opts(['--wrapper', '--size', '9.1x5', '--orientation', 'vertical'])
+        domdiv.calculate_layout(vertical, cards)
+        self.assertEquals(len(domdiv.packWrappers(cards, vertical)), 123)
@@ -0,0 +1,526 @@
+import os
+import re
+import sys
+import json
+import shutil
+import subprocess
+from multiprocessing.pool import ThreadPool
+import tempfile
+import threading
+import unittest
+from .. import domdiv
+
+
+class TestOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cardlist = os.path.join(self.tmpdir, 'cardlist.txt')
+        with open(self.cardlist, 'w') as f:
+            f.write('Cellar\nCopper\nWitch\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def generate(self, *args):
+        outfile = os.path.join(self.tmpdir, 'out%d.pdf' % len(os.listdir(self.tmpdir)))
+        options = domdiv.parse_opts(['--cardlist', self.cardlist, '--outfile', outfile] + list(args))
+        domdiv.generate(options, '.')
+        return outfile
+
+    def test_optimize_size(self):
+        plain = self.generate()
+        optimized = self.generate('--optimize-size')
+        self.assertLess(os.path.getsize(optimized), os.path.getsize(plain))
+        sizes = domdiv.pdf_resource_sizes(optimized)
+        self.assertGreater(sizes['images'], 0)
+        self.assertGreater(sizes['page content'], 0)
+
+    def test_images_embedded_once(self):
+        # the coin and debt on the tabs are the same images as those inline
+        # in the texts
+        with open(self.cardlist, 'w') as f:
+            f.write('Fortune\nCapital\nEngineer\nCellar\n')
+        with open(self.generate('--optimize-size', '--cost', 'tab', '--back', 'card'), 'rb') as f:
+            pdf = f.read()
+        images = [stream for header, stream in re.findall(r'obj\s*<<(.*?)>>\s*stream\r?\n(.*?)endstream', pdf, re.S)
+                  if '/Subtype /Image' in header]
+        self.assertTrue(images)
+        self.assertEqual(len(images), len(set(images)))
+
+    def test_deterministic(self):
+        first = self.generate('--deterministic')
+        second = self.generate('--deterministic')
+        with open(first, 'rb') as f1, open(second, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertEqual(domdiv.content_hash(first), domdiv.content_hash(second))
+
+    def test_back_reuses_front(self):
+        # a few short texts take less space drawn again than as forms
+        with open(self.generate('--back', 'card'), 'rb') as f:
+            self.assertEqual(f.read().count('/Subtype /Form'), 0)
+
+        def forms(cards, *args):
+            options = domdiv.parse_opts(list(args) + ['--outfile', os.path.join(self.tmpdir, 'forms.pdf')])
+            options.data_path = '.'
+            domdiv.calculate_layout(options, cards)
+            domdiv.DividerDrawer().draw(cards, options)
+            with open(options.outfile, 'rb') as f:
+                return f.read().count('/Subtype /Form')
+
+        options = domdiv.parse_opts(['--cardlist', self.cardlist])
+        options.data_path = '.'
+        witch = [c for c in domdiv.filter_sort_cards(domdiv.read_write_card_data(options), options)
+                 if c.name == 'Witch']
+        # a text shown often enough is drawn once, whichever sides show it
+        self.assertEqual(forms(witch * 10, '--back', 'card'), 1)
+        self.assertEqual(forms(witch * 20, '--back', 'blank'), 1)
+        # blank backs have nothing to share, unless they have icons
+        self.assertEqual(forms(witch * 5, '--front', 'blank', '--back', 'blank'), 0)
+        self.assertEqual(forms(witch * 5, '--front', 'blank', '--back', 'blank', '--cost', 'body-top'), 1)
+        job = domdiv.DividerDrawer().job(options, None)
+        self.assertEqual(job.textKey(witch[0], 'blank'), (None, None))
+
+    def test_shared_drawer_threads(self):
+        variants = [['--back', 'card'], ['--optimize-size'], ['--orientation', 'vertical'],
+                    ['--optimize-size', '--papersize', 'A4'], ['--wrapper'], []]
+
+        def job(args, outfile):
+            options = domdiv.parse_opts(['--cardlist', self.cardlist, '--deterministic',
+                                         '--outfile', outfile] + args)
+            options.data_path = '.'
+            cards = domdiv.filter_sort_cards(domdiv.read_write_card_data(options), options)
+            domdiv.calculate_layout(options, cards)
+            return cards, options
+
+        expected = []
+        for i, args in enumerate(variants):
+            cards, options = job(args, os.path.join(self.tmpdir, 'single%d.pdf' % i))
+            domdiv.DividerDrawer().draw(cards, options)
+            expected.append(domdiv.content_hash(options.outfile))
+
+        # one drawer used by several threads at once
+        dd = domdiv.DividerDrawer()
+        jobs = [job(args, os.path.join(self.tmpdir, 'shared%d.pdf' % i))
+                for i, args in enumerate(variants)]
+        pool = ThreadPool(len(jobs))
+        try:
+            pool.map(lambda (cards, options): dd.draw(cards, options), jobs)
+        finally:
+            pool.close()
+        self.assertEqual([domdiv.content_hash(options.outfile) for cards, options in jobs], expected)
+
+    def run_piped(self, *args):
+        # run as a script printing to a pipe, where Python 2 encodes printed
+        # unicode as ASCII, as it does when the output is redirected
+        env = dict(os.environ)
+        env.pop('PYTHONIOENCODING', None)
+        process = subprocess.Popen([sys.executable, 'dominion_dividers.py'] + list(args),
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+        return output
+
+    def test_languages_piped(self):
+        with open(self.cardlist, 'a') as f:
+            f.write(u'Tr\xe9sor perdu\n'.encode('utf-8'))
+        output = self.run_piped('--language', 'all', '--cardlist', self.cardlist,
+                                '--outfile', os.path.join(self.tmpdir, 'piped.pdf'))
+        self.assertEqual(output.count(u'"Tr\xe9sor perdu"'.encode('utf-8')), 4)
+        for language in ['de', 'en_us', 'fr', 'it']:
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'piped_{}.pdf'.format(language))))
+
+        manifest = os.path.join(self.tmpdir, 'kingdoms.jsonl')
+        with open(manifest, 'w') as f:
+            f.write(u'{"cards": ["Witch", "Tr\xe9sor perdu"]}\n'.encode('utf-8'))
+        output = self.run_piped('--kingdoms', manifest, '--outfile', os.path.join(self.tmpdir, 'kingdom.pdf'))
+        self.assertIn(u'unknown card(s) Tr\xe9sor perdu'.encode('utf-8'), output)
+
+    def test_a85_setting_threads(self):
+        plain = self.generate('--deterministic')
+
+        def job(args, outfile):
+            options = domdiv.parse_opts(['--cardlist', self.cardlist, '--deterministic',
+                                         '--outfile', outfile] + args)
+            options.data_path = '.'
+            cards = domdiv.filter_sort_cards(domdiv.read_write_card_data(options), options)
+            domdiv.calculate_layout(options, cards)
+            return cards, options
+
+        # the plain job starts while the optimized one has A85 switched off
+        dd = domdiv.DividerDrawer()
+        cards, options = job([], os.path.join(self.tmpdir, 'plain.pdf'))
+        plainJob = threading.Thread(target=dd.draw, args=(cards, options))
+
+        def started(kind, done, total, elapsed):
+            if plainJob.ident is None:
+                plainJob.start()
+                plainJob.join(0.5)
+
+        optimized = job(['--optimize-size'], os.path.join(self.tmpdir, 'optimized.pdf'))
+        dd.draw(*optimized, progress=started)
+        plainJob.join()
+        with open(plain, 'rb') as f1, open(options.outfile, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_render_pool(self):
+        expected = self.generate('--deterministic')
+        renderer = domdiv.RenderPool('.', workers=1)
+        try:
+            request = renderer.submit(['--cardlist', self.cardlist, '--deterministic'])
+            # waiting behind the first request, so dropped before it starts
+            cancelled = renderer.submit(['--cardlist', self.cardlist])
+            cancelled.cancel()
+            done = []
+            cancelled.add_done_callback(done.append)
+            with open(expected, 'rb') as f:
+                self.assertEqual(request.get(), f.read())
+            self.assertRaises(domdiv.RenderCancelled, cancelled.get)
+            self.assertEqual(done, [cancelled])
+        finally:
+            renderer.close()
+
+    def test_render_pool_catalogs(self):
+        # each card database is a catalog of its own, even for one language
+        from ..domdiv import carddb
+        options = domdiv.parse_opts([])
+        options.data_path = '.'
+        cards = domdiv.read_write_card_data(options)
+        renderer = domdiv.RenderPool('.', workers=1)
+        try:
+            for name in ['Cellar', 'Witch']:
+                db = os.path.join(self.tmpdir, name + '.sqlite')
+                conn = carddb.connect(db)
+                carddb.store_language(conn, 'en_us', [c for c in cards if c.name == name], {})
+                conn.close()
+                options = domdiv.parse_opts(['--sqlite_db', db])
+                options.data_path = '.'
+                self.assertEqual([c.name for c in renderer.catalog(options)], [name])
+        finally:
+            renderer.close()
+
+    def test_cancel_drawing(self):
+        options = domdiv.parse_opts(['--cardlist', self.cardlist,
+                                     '--outfile', os.path.join(self.tmpdir, 'cancelled.pdf')])
+        options.data_path = '.'
+        cards = domdiv.filter_sort_cards(domdiv.read_write_card_data(options), options)
+        domdiv.calculate_layout(options, cards)
+        cancel = threading.Event()
+        cancel.set()
+        self.assertRaises(domdiv.RenderCancelled, domdiv.DividerDrawer().draw, cards, options, cancel)
+
+    def test_progress(self):
+        options = domdiv.parse_opts(['--expansions', 'dominion', '--num_pages', '3',
+                                     '--outfile', os.path.join(self.tmpdir, 'progress.pdf')])
+        options.data_path = '.'
+        cards = domdiv.filter_sort_cards(domdiv.read_write_card_data(options), options)
+        domdiv.calculate_layout(options, cards)
+        events = []
+        cancel = threading.Event()
+
+        def progress(kind, done, total, elapsed):
+            events.append((kind, done, total))
+            if kind == 'divider' and done == 9:
+                cancel.set()
+
+        # 6 dividers a page, the third page without its backs
+        domdiv.DividerDrawer().draw(cards, options, progress=progress)
+        self.assertEqual(events[-1], ('page', 5, 5))
+        self.assertEqual([e for e in events if e[0] == 'divider'][-1], ('divider', 30, 30))
+        self.assertEqual(events[:7], [('divider', i, 30) for i in range(1, 7)] + [('page', 1, 5)])
+
+        events = []
+        cancel.clear()
+        self.assertRaises(domdiv.RenderCancelled, domdiv.DividerDrawer().draw,
+                          cards, options, cancel, progress=progress)
+        self.assertEqual(events[-1], ('divider', 9, 30))
+
+    def test_prefit_text(self):
+        outfile = os.path.join(self.tmpdir, 'prefit.pdf')
+        options = domdiv.parse_opts(['--expansions', 'dominion', '--workers', '2', '--deterministic',
+                                     '--back', 'rules', '--outfile', outfile])
+        options.data_path = '.'
+        cards = domdiv.filter_sort_cards(domdiv.read_write_card_data(options), options)
+        domdiv.calculate_layout(options, cards)
+        dd = domdiv.DividerDrawer()
+        domdiv.prefit_text(cards, options, dd)
+        fits = dict(dd.textFits)
+        self.assertTrue(fits)
+        # nothing is left to be fitted while drawing, and the result is the same
+        dd.draw(cards, options)
+        self.assertEqual(dd.textFits, fits)
+        expected = os.path.join(self.tmpdir, 'expected.pdf')
+        options.outfile = expected
+        domdiv.DividerDrawer().draw(cards, options)
+        self.assertEqual(domdiv.content_hash(outfile), domdiv.content_hash(expected))
+
+        # without --workers a few dividers are fitted while drawing, and so
+        # is everything with a single worker
+        self.assertEqual(domdiv.prefit_workers(cards, options), 2)
+        options.workers = None
+        self.assertEqual(domdiv.prefit_workers(cards, options), 0)
+        options.workers = 1
+        self.assertEqual(domdiv.prefit_workers(cards * 10, options), 0)
+
+    def test_dry_run(self):
+        outfile = os.path.join(self.tmpdir, 'dry.pdf')
+        report, = domdiv.main(['--cardlist', self.cardlist, '--outfile', outfile, '--dry-run'], '.')
+        self.assertFalse(os.path.exists(outfile))
+        # fronts and backs of one sheet
+        self.assertEqual(report['pages'], 2)
+        self.assertEqual(report['dividers_per_page'], [3])
+        self.assertEqual(sorted(sizes['name'] for sizes in report['cards']), ['Cellar', 'Copper', 'Witch'])
+        witch = next(sizes for sizes in report['cards'] if sizes['name'] == 'Witch')
+        self.assertEqual(witch['tab'], 12)
+        self.assertEqual(witch['text'], {'card': 10, 'rules': 10})
+        self.assertEqual(report['too_small'], [])
+
+        # the same number of pages as drawing them
+        domdiv.main(['--cardlist', self.cardlist, '--outfile', outfile], '.')
+        with open(outfile, 'rb') as f:
+            self.assertEqual(f.read().count('/Type /Page\n'), report['pages'])
+
+        renderer = domdiv.RenderPool('.', workers=1)
+        try:
+            report, = renderer.dry_run(['--cardlist', self.cardlist, '--tab_name_align', 'centre',
+                                        '--tabs-only', '--size', 'sleeved', '--use-text-set-icon'])
+        finally:
+            renderer.close()
+        self.assertEqual(report['pages'], 1)
+        self.assertEqual(report['cards'][0]['text'], {})
+
+    def test_batch_variants(self):
+        outfile = os.path.join(self.tmpdir, 'batch.pdf')
+        domdiv.main(['--cardlist', self.cardlist, '--outfile', outfile,
+                     '--variant', '--orientation vertical',
+                     '--variant', '--papersize A4'], '.')
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'batch_1.pdf')))
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'batch_2.pdf')))
+
+        # each card database is read on its own, even for one language
+        from ..domdiv import carddb
+        options = domdiv.parse_opts([])
+        options.data_path = '.'
+        cards = domdiv.read_write_card_data(options)
+        variants = []
+        for name in ['Cellar', 'Witch']:
+            db = os.path.join(self.tmpdir, name + '.sqlite')
+            conn = carddb.connect(db)
+            carddb.store_language(conn, 'en_us', [c for c in cards if c.name == name], {})
+            conn.close()
+            variants.extend(['--variant', '--sqlite_db {} --outfile {}'.format(db, db + '.pdf')])
+        domdiv.main(['--deterministic', '--outfile', outfile] + variants, '.')
+        self.assertNotEqual(domdiv.content_hash(os.path.join(self.tmpdir, 'Cellar.sqlite.pdf')),
+                            domdiv.content_hash(os.path.join(self.tmpdir, 'Witch.sqlite.pdf')))
+
+    def test_kingdoms(self):
+        manifest = os.path.join(self.tmpdir, 'kingdoms.jsonl')
+        with open(manifest, 'w') as f:
+            f.write('{"name": "first", "cards": ["Witch", "Moat", "Nonesuch"]}\n')
+            f.write('{"cardlist": "cardlist.txt"}\n')
+        outfile = os.path.join(self.tmpdir, 'kingdom.pdf')
+        results = domdiv.main(['--kingdoms', manifest, '--outfile', outfile, '--workers', '1'], '.')
+        self.assertEqual(sorted(results), [
+            (os.path.join(self.tmpdir, 'kingdom_2.pdf'), 3, []),
+            (os.path.join(self.tmpdir, 'kingdom_first.pdf'), 2, ['Nonesuch'])])
+        for fname, count, unknown in results:
+            self.assertTrue(os.path.exists(fname))
+
+        # English names pick the German cards (Kupfer is in two German sets)
+        results = domdiv.main(['--kingdoms', manifest, '--outfile', outfile, '--workers', '1',
+                               '--language', 'de'], '.')
+        self.assertEqual(sorted((count, unknown) for fname, count, unknown in results),
+                         [(2, ['Nonesuch']), (4, [])])
+
+        # names from the manifest cannot reach outside the output directory
+        with open(manifest, 'w') as f:
+            f.write('{"name": "../../escaped", "cards": ["Witch"]}\n')
+            f.write('{"name": "..", "cards": ["Moat"]}\n')
+            f.write('{"name": "a/b\\\\c", "cards": ["Cellar"]}\n')
+        results = domdiv.main(['--kingdoms', manifest, '--outfile', outfile, '--workers', '1'], '.')
+        self.assertEqual(sorted(os.path.basename(fname) for fname, count, unknown in results),
+                         ['kingdom__.pdf', 'kingdom_a_b_c.pdf', 'kingdom_escaped.pdf'])
+        for fname, count, unknown in results:
+            self.assertEqual(os.path.dirname(fname), self.tmpdir)
+            self.assertTrue(os.path.exists(fname))
+
+    def test_filter_signature(self):
+        vertical = domdiv.parse_opts(['--orientation', 'vertical'])
+        a4 = domdiv.parse_opts(['--papersize', 'A4'])
+        german = domdiv.parse_opts(['--language', 'de'])
+        self.assertEqual(domdiv.filter_signature(vertical), domdiv.filter_signature(a4))
+        self.assertNotEqual(domdiv.filter_signature(vertical), domdiv.filter_signature(german))
+
+    def test_preview(self):
+        from PIL import Image
+        outfile = os.path.join(self.tmpdir, 'preview.pdf')
+        cache = os.path.join(self.tmpdir, 'cache')
+        args = ['--cardlist', self.cardlist, '--outfile', outfile, '--preview_cache', cache]
+        preview = domdiv.main(args + ['--preview', '1'], '.')
+        self.assertEqual(preview, os.path.join(self.tmpdir, 'preview.png'))
+        self.assertEqual(Image.open(preview).size, (612, 792))
+        self.assertFalse(os.path.exists(outfile))
+        self.assertEqual(len(os.listdir(cache)), 1)
+        domdiv.main(args + ['--preview', '1'], '.')
+        self.assertEqual(len(os.listdir(cache)), 1)
+        domdiv.main(args + ['--preview_card', 'witch', '--preview_dpi', '144'], '.')
+        self.assertEqual(len(os.listdir(cache)), 2)
+        # one divider, 9.1cm wide at 144dpi
+        width, height = Image.open(preview).size
+        self.assertAlmostEqual(width, 9.1 / 2.54 * 144, delta=2)
+        self.assertLess(height, width)
+
+    def test_preview_fingerprint(self):
+        data_path = os.path.join(self.tmpdir, 'data')
+        os.mkdir(data_path)
+        for name in ['card_db', 'images']:
+            os.symlink(os.path.abspath(name), os.path.join(data_path, name))
+        os.mkdir(os.path.join(data_path, 'fonts'))
+        sqlite_db = os.path.join(self.tmpdir, 'cards.db')
+        with open(sqlite_db, 'w') as f:
+            f.write('one')
+        options = domdiv.parse_opts(['--cardlist', self.cardlist, '--sqlite_db', sqlite_db])
+        options.data_path = data_path
+        fingerprints = [domdiv.preview_fingerprint(options)]
+        self.assertEqual(domdiv.preview_fingerprint(options), fingerprints[0])
+        # the contents of every file the preview is drawn from count, not
+        # just the options naming them
+        for fname in [self.cardlist, sqlite_db, os.path.join(data_path, 'fonts', 'font.ttf')]:
+            with open(fname, 'a') as f:
+                f.write('more')
+            fingerprints.append(domdiv.preview_fingerprint(options))
+        self.assertEqual(len(set(fingerprints)), 4)
+
+    def test_preview_canvas(self):
+        # the preview canvases lean on reportlab internals (see setup.py for
+        # the versions they are known to work with), so draw a paragraph
+        # with an inline image on each of them
+        from reportlab.lib.styles import ParagraphStyle
+        from reportlab.platypus import Paragraph
+        from ..domdiv.preview import PreviewCanvas, SVGPreviewCanvas
+        text = 'Coin <img src="images/coin_small.png" width="10" height="10"/> <b>Text</b>'
+        png = PreviewCanvas(100, 20)
+        svg = SVGPreviewCanvas(100, 20)
+        for canvas in [png, svg]:
+            p = Paragraph(text, ParagraphStyle('test', fontName='Times-Roman', fontSize=10))
+            p.wrap(100, 20)
+            p.drawOn(canvas, 0, 0)
+        from PIL import ImageOps
+        drawn = ImageOps.invert(png.toPIL().convert('L')).point(lambda v: 255 if v > 128 else 0).getbbox()
+        # from the left edge past the image to the bold text
+        self.assertLess(drawn[0], 5)
+        self.assertGreater(drawn[2], 50)
+        fname = os.path.join(self.tmpdir, 'preview.svg')
+        svg.saveSVG(fname)
+        with open(fname) as f:
+            contents = f.read()
+        self.assertIn('Coin', contents)
+        self.assertIn('Text', contents)
+        self.assertIn('<image', contents)
+
+    def test_build_images(self):
+        from PIL import Image
+        data_path = os.path.join(self.tmpdir, 'data')
+        os.mkdir(data_path)
+        for name in ['card_db', 'fonts', 'images']:
+            os.symlink(os.path.abspath(name), os.path.join(data_path, name))
+
+        def generate(*args):
+            outfile = os.path.join(self.tmpdir, 'out%d.pdf' % len(os.listdir(self.tmpdir)))
+            domdiv.main(['--cardlist', self.cardlist, '--outfile', outfile, '--deterministic'] + list(args),
+                        data_path)
+            return outfile
+
+        full = generate('--image_dpi', '150')
+        domdiv.main(['--build_images', '--image_dpi', '150'], data_path)
+        scaled_dir = os.path.join(data_path, 'images_150dpi')
+        self.assertEqual(sorted(os.listdir(scaled_dir)), sorted(os.listdir('images')))
+        # 14x12pt at 150dpi
+        self.assertEqual(Image.open(os.path.join(scaled_dir, 'empires_set.png')).size, (30, 27))
+        # drawn across the whole tab, so left as it is
+        self.assertEqual(Image.open(os.path.join(scaled_dir, 'action.png')).size,
+                         Image.open(os.path.join('images', 'action.png')).size)
+
+        scaled = generate('--image_dpi', '150')
+        self.assertLess(os.path.getsize(scaled), os.path.getsize(full))
+        # only used for the resolution they were made for, and not at all
+        # with --full_resolution_images
+        for args in [['--image_dpi', '300'], ['--image_dpi', '150', '--full_resolution_images']]:
+            with open(full, 'rb') as f1, open(generate(*args), 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_tiles(self):
+        tiles = os.path.join(self.tmpdir, 'tiles')
+        args = ['--cardlist', self.cardlist, '--tiles', tiles, '--workers', '2']
+        index = domdiv.main(args, '.')
+        self.assertEqual(sorted(tile['name'] for tile in index), ['Cellar', 'Copper', 'Witch'])
+        self.assertEqual(len(os.listdir(tiles)), 4)
+        # only the new divider is rendered, and the one dropped is removed
+        with open(self.cardlist, 'w') as f:
+            f.write('Cellar\nWitch\nMoat\n')
+        mtimes = {tile['file']: os.path.getmtime(os.path.join(tiles, tile['file'])) for tile in index}
+        index = domdiv.main(args, '.')
+        self.assertEqual(sorted(os.listdir(tiles)), sorted([tile['file'] for tile in index] + ['index.json']))
+        unchanged = [tile['file'] for tile in index if tile['name'] != 'Moat']
+        self.assertEqual([os.path.getmtime(os.path.join(tiles, f)) for f in unchanged],
+                         [mtimes[f] for f in unchanged])
+        index = domdiv.main(args + ['--tile_format', 'svg'], '.')
+        with open(os.path.join(tiles, index[0]['file'])) as f:
+            self.assertIn('<svg', f.read())
+
+    def test_split_by(self):
+        outfile = os.path.join(self.tmpdir, 'split.pdf')
+        manifest, = domdiv.main(['--expansions', 'dominion', '--expansions', 'intrigue',
+                                 '--outfile', outfile, '--split-by', 'expansion'], '.')
+        with open(manifest) as f:
+            groups = json.load(f)
+        self.assertEqual([g['group'] for g in groups], ['dominion', 'intrigue'])
+        for g in groups:
+            self.assertTrue(os.path.exists(g['file']))
+        self.assertFalse(os.path.exists(outfile))
+
+        # 9 dividers a page, so the tabs of the second page start on the other side
+        options = domdiv.parse_opts(['--expansions', 'dominion', '--size', '6x6',
+                                     '--tab_side', 'left-alternate', '--split-by', 'pages:1'])
+        options.data_path = '.'
+        cards = domdiv.filter_sort_cards(domdiv.read_write_card_data(options), options)
+        domdiv.calculate_layout(options, cards)
+        groups = domdiv.split_groups(cards, options, domdiv.DividerDrawer())
+        self.assertEqual([(name, len(groupCards), odd) for name, groupCards, odd in groups],
+                         [('pages1-1', 9, False), ('pages2-2', 9, True), ('pages3-3', 7, False)])
+        self.assertRaises(SystemExit, domdiv.parse_opts, ['--split-by', 'pages:0'])
+
+        def pages(fname):
+            with open(fname, 'rb') as f:
+                return f.read().count('/Type /Page\n')
+
+        # wrappers are packed into the rows of the layout of all the cards,
+        # so the groups have the pages they have in the single file
+        args = ['--expansions', 'base', '--expansions', 'alchemy', '--wrapper', '--size', '9.1x5',
+                '--workers', '1']
+        single = os.path.join(self.tmpdir, 'wrappers.pdf')
+        domdiv.main(args + ['--outfile', single], '.')
+        manifest, = domdiv.main(args + ['--outfile', outfile, '--split-by', 'pages:2'], '.')
+        with open(manifest) as f:
+            groups = json.load(f)
+        counts = [pages(g['file']) for g in groups]
+        self.assertEqual(counts, [2] * (len(counts) - 1) + [counts[-1]])
+        self.assertEqual(sum(counts), pages(single))
+        # an expansion takes the pages it takes on its own
+        manifest, = domdiv.main(args + ['--outfile', outfile, '--split-by', 'expansion'], '.')
+        with open(manifest) as f:
+            alchemy = [pages(g['file']) for g in json.load(f) if g['group'] == 'alchemy']
+        alone = os.path.join(self.tmpdir, 'alchemy.pdf')
+        domdiv.main(['--expansions', 'alchemy', '--wrapper', '--size', '9.1x5', '--outfile', alone], '.')
+        self.assertEqual(alchemy, [pages(alone)])
+
+    def test_watch_changes(self):
+        before = domdiv.watch_snapshot('.', ['en_us', 'de'])
+        after = dict(before)
+        cards_de = os.path.join('.', 'card_db', 'de', 'cards.json')
+        after[cards_de] = ('de', after[cards_de][1] + 1)
+        self.assertEqual(domdiv.changed_languages(before, before), set())
+        self.assertEqual(domdiv.changed_languages(before, after), set(['de']))
+        new_image = os.path.join('.', 'images', 'new.png')
+        after[new_image] = (None, 0)
+        self.assertEqual(domdiv.changed_languages(before, after), set(['de', None]))
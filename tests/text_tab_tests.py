@@ -298,3 +298,36 @@ class TestTextTabs(unittest.TestCase):
         self.assertEquals(options.tab_name_align,
                           'centre')  # check for change in value
         self.assertEquals(options.tab_side, 'left')
+
+    ####################
+    # Tab Name Width Tests
+    ####################
+    def test_tab_name_width(self):
+        from reportlab.pdfbase import pdfmetrics
+        dd = domdiv.DividerDrawer()
+        dd.registerFonts('.')
+        font = dd.fontNameRegular
+        for name in [u'VILLAGE', u'BAND OF MISFITS', u'BLACK CAT / CHAT NOIR', u'\xc9TAT']:
+            for fontSize in [8, 10.5, 12]:
+                # the first letter of each word at full size, the rest 2 points smaller
+                width = sum(pdfmetrics.stringWidth(word[0], font, fontSize) +
+                            pdfmetrics.stringWidth(word[1:], font, fontSize - 2)
+                            for word in name.split())
+                width += pdfmetrics.stringWidth(' ', font, fontSize) * (len(name.split()) - 1)
+                self.assertAlmostEqual(dd.nameWidth(name, fontSize), width)
+
+    def test_fit_tab_names(self):
+        dd = domdiv.DividerDrawer()
+        dd.registerFonts('.')
+        options = domdiv.parse_opts([])
+        options.data_path = '.'
+        names = [c.name.upper() for c in domdiv.read_write_card_data(options)]
+        for textWidth in [40, 80, 120]:
+            for name in names:
+                # the same as trying the sizes one after the other
+                fontSize = 12
+                width = dd.nameWidth(name, fontSize)
+                while width > textWidth and fontSize > 8:
+                    fontSize -= .01
+                    width = dd.nameWidth(name, fontSize)
+                self.assertEqual(dd.fitTabName(name, 12, textWidth), (fontSize, width))
@@ -0,0 +1,83 @@
+# coding=utf-8
+# Gives every card in the card databases a card_id, the same in every
+# language.  English cards are named after themselves; the cards of the
+# other languages keep the id they have, or get that of the English card of
+# the same name, if the card is not translated or mapping.json translates
+# it.  Cards that cannot be matched are listed, to be given an id by hand,
+# and the script fails.  The card_id lines are added to cards.json without
+# touching anything else.
+import os
+import sys
+import json
+import codecs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from domdiv.cards import cardId  # noqa: E402
+
+CARD_DB = os.path.join(os.path.dirname(__file__), '..', 'card_db')
+
+
+def load(language):
+    data_dir = os.path.join(CARD_DB, language)
+    with codecs.open(os.path.join(data_dir, 'cards.json'), 'r', 'utf-8') as cardfile:
+        cards = json.load(cardfile)
+    with codecs.open(os.path.join(data_dir, 'mapping.json'), 'r', 'utf-8') as mapping_file:
+        mapping = json.load(mapping_file)
+    return cards, mapping
+
+
+def match_language(english, cards, mapping):
+    # returns the English card of each card that has the same name, or is
+    # translated to it by mapping.json, else None
+    english_by_name = {card['name'].lower(): card for card in english}
+    return [english_by_name.get(mapping.get(card['name'], card['name']).lower()) for card in cards]
+
+
+def write_ids(language, ids):
+    # adds a "card_id" line at the top of each card, indented and ended like
+    # the line after it
+    fname = os.path.join(CARD_DB, language, 'cards.json')
+    with codecs.open(fname, 'r', 'utf-8') as cardfile:
+        lines = cardfile.read().split('\n')
+    ids = iter(ids)
+    out = []
+    for i, line in enumerate(lines):
+        if line.rstrip().endswith('{'):
+            card_id = next(ids)
+            following = lines[i + 1]
+            indent = following[:len(following) - len(following.lstrip())]
+            ending = following[len(following.rstrip(', ')):] if following.rstrip().endswith(',') else ','
+            if card_id is not None and '"card_id"' not in following:
+                out.append(line)
+                out.append(u'{}"card_id": "{}"{}'.format(indent, card_id, ending))
+                continue
+        out.append(line)
+    with codecs.open(fname, 'w', 'utf-8') as cardfile:
+        cardfile.write('\n'.join(out))
+
+
+def main():
+    unmatched = 0
+    english, _ = load('en_us')
+    write_ids('en_us', [card.get('card_id') or cardId(card['name']) for card in english])
+    for language in sorted(os.listdir(CARD_DB)):
+        if language == 'en_us' or not os.path.isdir(os.path.join(CARD_DB, language)):
+            continue
+        cards, mapping = load(language)
+        matches = match_language(english, cards, mapping)
+        ids = []
+        for card, match in zip(cards, matches):
+            if card.get('card_id'):
+                ids.append(card['card_id'])
+            elif match is not None:
+                ids.append(cardId(match['name']))
+            else:
+                ids.append(None)
+                unmatched += 1
+                print u'{}: no match for "{}" ({})'.format(language, card['name'], card['cardset']).encode('utf-8')
+        write_ids(language, ids)
+    return 1 if unmatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
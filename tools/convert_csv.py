@@ -1,40 +1,210 @@
 # coding=utf-8
+# Merges a spreadsheet of translated cards, saved as CSV, into the cards.json
+# of its language.  A config file (see convert_csv_de.json) gives the
+# language, the encoding, the column of each card field, the type names and
+# the types whose cards are one pile in the database.
+#
+# Cards are matched up by card_id if the spreadsheet has a column for it, by
+# set and name otherwise.  Cards the spreadsheet leaves alone keep their
+# place and the exact text they had, so a spreadsheet with a few fixes only
+# changes those cards, and a spreadsheet without any leaves cards.json (and
+# the compiled database made from it) as it was.  Changed cards keep the
+# fields the spreadsheet has no column for, new cards go at the end and
+# cards missing from the spreadsheet are removed.
+#
+#   python tools/convert_csv.py CONFIG CSVFILE [--dry-run] [--sqlite_db DB]
+import os
+import re
 import csv
 import sys
 import json
-import chardet
-
-converted = []
-
-typemap = {'Aktion': 'Action',
-           'Geld': 'Treasure',
-           'Fluch': 'Curse',
-           'Punkte': 'Victory',
-           'Reaktion': 'Reaction',
-           'Angriff': 'Attack',
-           'Dauer': 'Duration',
-           'Plündern': 'Looter',
-           'Ritter': 'Knight',
-           'Ruine': 'Ruins',
-           'Unterschlupf': 'Shelter',
-           'Reisender': 'Traveller',
-           'Reserve': 'Reserve'}
-
-with open(sys.argv[1], 'U') as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        if not row['Typ']:
+import codecs
+import collections
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from domdiv import carddb  # noqa: E402
+from domdiv.cards import Card  # noqa: E402
+
+CARD_DB = os.path.join(os.path.dirname(__file__), '..', 'card_db')
+
+FIELDS = ['name', 'cost', 'cardset', 'description', 'extra', 'types', 'potcost']
+# what a new card has in the fields the spreadsheet has no column for
+NEW_CARD = {'name': u'', 'cost': u'', 'cardset': u'', 'description': u'', 'extra': u'', 'types': [],
+            'potcost': 0}
+
+
+def read_rows(csvfile, config):
+    # yields the cards of the spreadsheet one row at a time, with the row
+    # number for error messages
+    columns = config['columns']
+    separator = config.get('type_separator', '/')
+    piles = config.get('piles', {})
+    encoding = config.get('encoding', 'utf-8')
+    for rownum, row in enumerate(csv.DictReader(csvfile), 2):
+        row = {k.decode(encoding) if isinstance(k, str) else k: v.decode(encoding) if isinstance(v, str) else v
+               for k, v in row.iteritems()}
+
+        def value(field, default=u''):
+            return row.get(columns.get(field)) or default
+
+        types = [t.strip() for t in value('types').split(separator) if t.strip()]
+        if not types:
+            # headings and empty rows
             continue
-        # row = {k: v.decode('ISO-8859-2').encode('utf-8') if type(v) == str else v for k, v in row.iteritems()}
-        #print chardet.detect(row['Kartentext'])
-        if 'Ritter' in row['Typ'] and row['Kartenname'] != 'Ritter':
+        pile = next((t for t in types if t in piles), None)
+        if pile is not None:
+            if value('name') != piles[pile]:
+                continue
+            types.remove(pile)
+        unknown = [t for t in types if t not in config['types']]
+        if unknown:
+            raise ValueError(u'row {}: unknown type(s) {}'.format(rownum, u', '.join(unknown)).encode('utf-8'))
+
+        # only the fields the spreadsheet has a column for, so the others
+        # are left as they are
+        card = {'types': [config['types'][t] for t in types]}
+        for field in ['name', 'cost', 'cardset', 'description', 'extra']:
+            if field in columns:
+                card[field] = value(field)
+        if 'potcost' in columns:
+            card['potcost'] = int(value('potcost', u'0').strip() or 0)
+        if value('card_id').strip():
+            card['card_id'] = value('card_id').strip()
+        yield rownum, card
+
+
+def card_key(card):
+    return card.get('card_id') or (card['cardset'], card['name'])
+
+
+def read_entries(text):
+    # splits the text of a cards.json into what comes before the first card,
+    # each card with the text it was read from and the separator after it, and
+    # what comes after the last one
+    decoder = json.JSONDecoder(object_pairs_hook=collections.OrderedDict)
+    start = text.index('[') + 1
+    pos = re.compile(r'\s*').match(text, start).end()
+    head = text[:pos]
+    entries = []
+    while text[pos] != ']':
+        card, end = decoder.raw_decode(text, pos)
+        card_text = text[pos:end]
+        pos = re.compile(r'\s*,?\s*').match(text, end).end()
+        entries.append((card, card_text, text[end:pos]))
+    if not entries:
+        return head, entries, text[pos:]
+    # the last separator is what comes before the closing bracket
+    card, card_text, separator = entries.pop()
+    entries.append((card, card_text, u''))
+    return head, entries, separator + text[pos:]
+
+
+def entry_text(card, like):
+    # a card written out the way the card like it is written, as far as
+    # indentation, separators and escapes go
+    lines = like.split('\n')
+    indent = len(lines[1]) - len(lines[1].lstrip()) if len(lines) > 1 else 1
+    first = len(lines[-1]) - len(lines[-1].lstrip()) if len(lines) > 1 else 0
+    comma = ', ' if any(line.endswith(', ') for line in lines) else ','
+    ensure_ascii = '\\u' in like or all(ord(char) < 128 for char in like)
+    text = json.dumps(card, indent=max(1, indent - first), ensure_ascii=ensure_ascii, separators=(comma, ': '))
+    return text.replace('\n', '\n' + ' ' * first)
+
+
+def merge(entries, rows):
+    # returns the merged cards, each with its text and separator, and the
+    # names of the added, changed and removed cards
+    incoming = {}
+    added = []
+    for rownum, card in rows:
+        key = card_key(card)
+        if key in incoming:
+            raise ValueError(u'row {}: "{}" appears twice'.format(rownum, card['name']).encode('utf-8'))
+        incoming[key] = card
+        added.append(key)
+
+    merged = []
+    changed = []
+    removed = []
+    seen = set()
+    for card, text, separator in entries:
+        key = card_key(card)
+        if key not in incoming and card.get('card_id'):
+            # the spreadsheet does not know the card's id
+            key = (card['cardset'], card['name'])
+        if key not in incoming:
+            removed.append(card['name'])
             continue
-        converted_row = {'name': row['Kartenname'],
-                         'cost': row['Kosten'],
-                         'cardset': row['Edition'],
-                         'description': row['Kartentext'],
-                         'extra': row['Lange Erklärung'],
-                         'types': [typemap[t.strip()] for t in row['Typ'].split('/') if not t.strip() == 'Ritter'],
-                         'potcost': row.get('potcost', 0)}
-        converted.append(converted_row)
-json.dump(converted, open(sys.argv[2], 'wb'), indent=True)
+        seen.add(key)
+        update = incoming[key]
+        if all(card.get(field, 0 if field == 'potcost' else None) == update[field]
+               for field in FIELDS if field in update):
+            merged.append((card, text, separator))
+        else:
+            card = collections.OrderedDict(card)
+            card.update(update)
+            merged.append((card, entry_text(card, text), separator))
+            changed.append(card['name'])
+    added = [dict(NEW_CARD, **incoming[key]) for key in added if key not in seen]
+    like = entries[-1][1] if entries else u'{\n "name": ""\n}'
+    merged.extend((collections.OrderedDict(sorted(card.items())), u'', u'') for card in added)
+    merged = [(card, text or entry_text(card, like), separator) for card, text, separator in merged]
+    return merged, [card['name'] for card in added], changed, removed
+
+
+def merged_text(head, entries, merged, tail):
+    # the text of the merged cards.json, the cards separated as they were,
+    # or as most of them were if they were not next to each other before
+    separators = collections.Counter(separator for card, card_text, separator in entries if separator)
+    common = separators.most_common(1)[0][0] if separators else u',\n'
+    parts = [head]
+    for i, (card, card_text, separator) in enumerate(merged):
+        parts.append(card_text)
+        if i < len(merged) - 1:
+            parts.append(separator or common)
+    parts.append(tail)
+    return u''.join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge a CSV card spreadsheet into cards.json')
+    parser.add_argument('config', help='the JSON config describing the spreadsheet')
+    parser.add_argument('csvfile', help='the spreadsheet, saved as CSV')
+    parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                        help='only report what would change')
+    parser.add_argument('--sqlite_db', help='store the merged cards in this SQLite card database too')
+    args = parser.parse_args()
+
+    with codecs.open(args.config, 'r', 'utf-8') as config_file:
+        config = json.load(config_file)
+    fname = os.path.join(CARD_DB, config['language'], 'cards.json')
+    with codecs.open(fname, 'r', 'utf-8') as cardfile:
+        text = cardfile.read()
+    head, entries, tail = read_entries(text)
+
+    with open(args.csvfile, 'rU') as csvfile:
+        merged, added, changed, removed = merge(entries, read_rows(csvfile, config))
+
+    for what, names in [('added', added), ('changed', changed), ('removed', removed)]:
+        print u'{} {}{}'.format(len(names), what, u': ' + u', '.join(names) if names else u'').encode('utf-8')
+    if args.dry_run:
+        return
+
+    if added or changed or removed:
+        with codecs.open(fname, 'w', 'utf-8') as cardfile:
+            cardfile.write(merged_text(head, entries, merged, tail))
+        print 'Wrote ' + fname
+
+    if args.sqlite_db:
+        conn = carddb.connect(args.sqlite_db)
+        try:
+            carddb.store_language(conn, config['language'],
+                                  [Card.decode_json(dict(card)) for card, card_text, separator in merged])
+        finally:
+            conn.close()
+        print 'Stored {} cards in {}'.format(len(merged), args.sqlite_db)
+
+
+if __name__ == '__main__':
+    main()